@@ -1,21 +1,222 @@
 import os
-from flask import Flask, send_file, request, jsonify, json
+import sqlite3
+import threading
+import traceback
+from urllib.parse import quote
+from flask import Flask, Response, abort, send_file, request, jsonify, json, url_for
 from file_converter import Converter
 from fanfiction_net_api import *
+from epub_cache import EpubCache, safe_filename
+import jobs
+import fanfiction_net_api
+import metadata_index
+from metrics import metrics
 
 app = Flask(__name__)
 
+# Guards the creation of the objects below, concurrent first requests must not create two of them
+_create_lock = threading.Lock()
+
+# Created on first use, so every server process gets its own worker threads
+_job_queue = None
+
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        with _create_lock:
+            if _job_queue is None:
+                _job_queue = jobs.JobQueue()
+    return _job_queue
+
+
+# Created on first use like the job queue, every server process indexes the stories it parses
+_metadata_index = None
+_metadata_index_failed = False
+
+
+def get_metadata_index():
+    """
+    :return: The metadata index of this process, or None if it can't be opened, e.g. without SQLite FTS5 or a
+             writable cache directory. The failure is printed once, the rest of the app works without the index.
+    """
+    global _metadata_index, _metadata_index_failed
+    if _metadata_index is None and not _metadata_index_failed:
+        with _create_lock:
+            if _metadata_index is None and not _metadata_index_failed:
+                try:
+                    index = metadata_index.MetadataIndex()
+                except (sqlite3.Error, OSError):
+                    traceback.print_exc()
+                    _metadata_index_failed = True
+                    return None
+                index.attach()
+                if metadata_index.METADATA_REFRESH_INTERVAL > 0:
+                    index.start()
+                _metadata_index = index
+    return _metadata_index
+
+
+def _required_metadata_index():
+    index = get_metadata_index()
+    if index is None:
+        abort(503)
+    return index
+
+
+@app.before_request
+def _index_parsed_metadata():
+    get_metadata_index()
+
 
 @app.route("/")
 def home():
     return "Hello world"
 
 
+def _attachment(title):
+    """Returns a Content-Disposition value offering title.epub for download, also for non-ASCII titles."""
+    filename = '%s.epub' % safe_filename(title)
+    fallback = filename.encode('ascii', 'replace').decode('ascii').replace('"', '_')
+    return 'attachment; filename="%s"; filename*=UTF-8\'\'%s' % (fallback, quote(filename))
+
+
+def _conditional(response, convert):
+    """Makes response revalidatable by the version of the story, it turns into a 304 when the client has it."""
+    response.set_etag(EpubCache.etag(convert.cache_key))
+    response.last_modified = convert.fanfic.date_updated
+    return response.make_conditional(request)
+
+
 @app.route("/fanfiction_epub/<story_id>", methods=["GET", "POST"])
 def fanfic_to_epub(story_id):
     convert = Converter(int(story_id))
-    path = convert.convert_to_epub()
-    return send_file(path, as_attachment=True)
+    path = convert.cached_epub()
+    if convert.cache_key is not None:
+        # The book only changes with the story, so clients can revalidate before anything is built
+        not_modified = _conditional(Response(), convert)
+        if not_modified.status_code == 304:
+            return not_modified
+
+    if path is not None:
+        response = send_file(path, conditional=False)
+    else:
+        # Send the book while its chapters are still being downloaded
+        response = Response(convert.stream_epub(), mimetype='application/epub+zip')
+    response.headers['Content-Disposition'] = _attachment(convert.fanfic.title)
+
+    if convert.cache_key is not None:
+        _conditional(response, convert)
+    return response
+
+
+def _job_response(job, status=200):
+    data = dict(job)
+    data['status_url'] = url_for('job_status', job_id=job['id'], _external=True)
+    if job['status'] == jobs.DONE:
+        data['download_url'] = url_for('job_download', job_id=job['id'], _external=True)
+    del data['path']
+    return jsonify(data), status
+
+
+@app.route("/jobs/fanfiction_epub/<story_id>", methods=["GET", "POST"])
+def enqueue_fanfic_to_epub(story_id):
+    """Starts converting a story in the background and returns the job right away."""
+    job_queue = get_job_queue()
+    job_id = job_queue.submit(int(story_id))
+    return _job_response(job_queue.get(job_id), 202)
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        abort(404)
+    return _job_response(job)
+
+
+@app.route("/jobs/<job_id>/download", methods=["GET"])
+def job_download(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        abort(404)
+    if job['status'] != jobs.DONE:
+        return _job_response(job, 409)
+    if not os.path.exists(job['path']):
+        # Evicted from the epub cache since, the story has to be converted again
+        abort(410)
+    response = send_file(job['path'], conditional=True)
+    response.headers['Content-Disposition'] = _attachment(job['title'])
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Counters and timers of this process in the Prometheus text format."""
+    stats = fanfiction_net_api.rate_limiter.stats()
+    gauges = {
+        'fanfiction_upstream_rate': stats['rate'],
+        'fanfiction_upstream_max_rate': stats['max_rate'],
+        'fanfiction_upstream_queued': stats['queued'],
+    }
+    counters = {
+        'fanfiction_upstream_requests_total': stats['requests'],
+        'fanfiction_upstream_throttled_total': stats['throttled'],
+    }
+    return Response(metrics.render(gauges, counters), mimetype='text/plain; version=0.0.4')
+
+
+def _int_arg(name):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+@app.route("/index/stories", methods=["GET"])
+def indexed_stories():
+    """Lists the indexed stories matching the query parameters, see MetadataIndex.stories."""
+    complete = request.args.get('complete')
+    offset = _int_arg('offset') or 0
+    if offset < 0:
+        abort(400)
+    try:
+        stories = _required_metadata_index().stories(
+            fandom=request.args.get('fandom'), character=request.args.get('character'),
+            genre=request.args.get('genre'), text=request.args.get('q'), min_words=_int_arg('min_words'),
+            max_words=_int_arg('max_words'), updated_since=_int_arg('updated_since'),
+            min_follows=_int_arg('min_follows'), complete=None if complete is None else complete in ('1', 'true'),
+            rated=request.args.get('rated'), language=request.args.get('language'),
+            order_by=request.args.get('order', 'date_updated'), limit=max(1, min(_int_arg('limit') or 50, 500)),
+            offset=offset)
+    except ValueError:
+        abort(400)
+    return jsonify(stories)
+
+
+@app.route("/index/stories/<story_id>", methods=["GET", "POST"])
+def indexed_story(story_id):
+    """Returns the indexed metadata of a story, a POST adds it to the stories the background refresh fetches."""
+    index = _required_metadata_index()
+    if request.method == 'POST':
+        index.track([int(story_id)])
+    story = index.story(int(story_id))
+    if story is None:
+        if request.method == 'POST':
+            return jsonify({'id': int(story_id)}), 202
+        abort(404)
+    return jsonify(story)
+
+
+@app.route("/index/users/<user_id>", methods=["GET"])
+def indexed_user(user_id):
+    user = _required_metadata_index().user(int(user_id))
+    if user is None:
+        abort(404)
+    return jsonify(user)
 
 
 # @app.route("/download_recs", methods=["GET"])
@@ -0,0 +1,124 @@
+"""
+Synthetic fanfiction.net pages for the benchmarks.
+
+The pages follow the markup the parsers of fanfiction_net_api rely on. Story ids select a size profile, so the same
+stand-in serves small, medium and very large stories.
+"""
+import html
+
+# Size profiles of the benchmarked stories
+SIZES = {
+    'small': {'story_id': 1, 'chapters': 3, 'paragraphs': 40, 'review_pages': 2},
+    'medium': {'story_id': 2, 'chapters': 40, 'paragraphs': 150, 'review_pages': 10},
+    'large': {'story_id': 3, 'chapters': 400, 'paragraphs': 300, 'review_pages': 100},
+}
+
+REVIEWS_PER_PAGE = 15
+FAVOURITE_STORIES = 50
+
+_UPDATED = 1469640000
+_PUBLISHED = 1260000000
+
+
+def profile(story_id):
+    """Returns the size profile of a story id, unknown ids are small stories."""
+    for size in SIZES.values():
+        if size['story_id'] == story_id:
+            return size
+    return dict(SIZES['small'], story_id=story_id)
+
+
+def chapter_text(chapter, paragraphs):
+    """Returns the storytext html of a chapter."""
+    return ''.join('<p>Paragraph %d of chapter %d, with <em>some</em> markup &amp; entities: &quot;quoted&quot;.</p>\n'
+                   % (i, chapter) for i in range(paragraphs)) + '<hr size=1 noshade>'
+
+
+def _description(size):
+    return ("Rated: <a class='xcontrast_txt' href='https://www.fictionratings.com/' target='rating'>Fiction  T</a> - "
+            "English - Romance/Drama - Chapters: %d - Words: %s - Reviews: <a href='/r/%d/'>%d</a> - Favs: 2,515 - "
+            "Follows: 2,207 - Updated: <span data-xutime='%d'>7/27/2016</span> - Published: <span data-xutime='%d'>"
+            "12/17/2009</span> - Naruto U., Hinata H. - id: %d" %
+            (size['chapters'], '{:,}'.format(size['chapters'] * size['paragraphs'] * 12), size['story_id'],
+             size['review_pages'] * REVIEWS_PER_PAGE, _UPDATED, _PUBLISHED, size['story_id']))
+
+
+def story_page(story_id, chapter=1):
+    """Returns the page of a chapter of a story, chapter 1 is the story page."""
+    size = profile(story_id)
+    chapter = min(chapter, size['chapters'])
+    options = ''.join('<option value=%d %s>%d. Chapter title %d</option>' % (i, 'selected' if i == chapter else '', i, i)
+                      for i in range(1, size['chapters'] + 1))
+    select = ('<select id=chap_select title="Chapter Navigation" name=chapter onChange="self.location=\'/s/%d/\'">'
+              '%s</select>' % (story_id, options))
+    return """<!DOCTYPE html><html><head><title>Story %(id)d</title>
+<script>var storyid = %(id)d; var chapter = %(chapter)d; var title = 'A+Story+Title+%(id)d'; var userid = 42;
+var storytextid = storytextid=%(textid)d;</script></head><body>
+<div id=pre_story_links><span class=lc-left><a class=xcontrast_txt href='/anime/'>Anime</a><span class=xcontrast_txt>
+<a class=xcontrast_txt href='/anime/Naruto/'>Naruto</a></span></span></div>
+<div id=profile_top><b class='xcontrast_txt'>A Story Title %(id)d</b>
+<span class='xgray xcontrast_txt'>%(description)s </span></div>
+%(select)s
+<div class='storytext xcontrast_txt nocopy' id='storytext'>%(text)s
+<div class='a2a_kit a2a_default_style'><a class='a2a_button_facebook'></a></div></div>
+%(select)s
+</body></html>""" % {'id': story_id, 'chapter': chapter, 'textid': story_id * 1000 + chapter,
+                     'description': _description(size), 'select': select,
+                     'text': chapter_text(chapter, size['paragraphs'])}
+
+
+def review_page(story_id, chapter=0, page=1):
+    """Returns a page of reviews, pages after the last one have no reviews."""
+    size = profile(story_id)
+    pages = size['review_pages']
+    reviews = []
+    if page <= pages:
+        for i in range(REVIEWS_PER_PAGE):
+            number = (page - 1) * REVIEWS_PER_PAGE + i
+            if number % 4 == 0:
+                reviewer = 'Guest %d' % number
+            else:
+                reviewer = "<a href='/u/%d/reviewer-%d'>reviewer %d</a>" % (1000 + number, number, number)
+            reviews.append("<tr><td style='padding-top:10px;padding-bottom:10px'><img class='lazy round36 ' "
+                           "src='/static/images/d_60_90.jpg' width=36 height=36> %s <small style='color:gray'>"
+                           "chapter %d . <span data-xutime='%d'>7/27/2016</span></small>"
+                           "<div style='margin-top:5px'>Review %d, looking forward to the next chapter!</div></td></tr>"
+                           % (reviewer, number % size['chapters'] + 1, _UPDATED - number * 60, number))
+    pagination = ''
+    if pages > 1:
+        pagination = "<center style='margin-top:5px;margin-bottom:5px;'>%s <a href='/r/%d/%d/%d/'>Last</a></center>" % (
+            ' '.join("<a href='/r/%d/%d/%d/'>%d</a>" % (story_id, chapter, i, i) for i in range(1, min(pages, 5) + 1)),
+            story_id, chapter, pages)
+    return ("<!DOCTYPE html><html><head><title>Reviews</title></head><body>%s"
+            "<table class='table table-striped' style='margin-top:10px;'><tbody>%s</tbody></table>%s</body></html>"
+            % (pagination, ''.join(reviews), pagination))
+
+
+def _storylist_entry(story_id):
+    size = profile(story_id)
+    return ("<div class='z-list favstories' data-storyid=%d data-category='Naruto' data-dateadded='%d' "
+            "data-datesubmit='%d' data-dateupdate='%d' data-title='%s' data-wordcount=1234 data-chapters=%d>"
+            "<a class=stitle href='/s/%d/1/'>%s</a> by <a href='/u/%d/author-%d'>author %d</a>"
+            "<div class='z-indent z-padtop'>A summary of story %d."
+            "<div class='z-padtop2 xgray'>Naruto - %s</div></div></div>"
+            % (story_id, _PUBLISHED, _PUBLISHED, _UPDATED, html.escape('Story %d' % story_id), size['chapters'],
+               story_id, html.escape('Story %d' % story_id), story_id + 500, story_id, story_id, story_id,
+               _description(size)))
+
+
+def user_page(user_id):
+    """Returns the profile page of a user with FAVOURITE_STORIES favourite stories."""
+    favourites = ''.join(_storylist_entry(100 + i) for i in range(FAVOURITE_STORIES))
+    authors = ''.join("<tr><td><a href='/u/%d/author-%d'>author %d</a></td></tr>" % (600 + i, i, i) for i in range(20))
+    return ("<!DOCTYPE html><html><head><title>User</title>"
+            "<link rel=\"canonical\" href=\"//www.fanfiction.net/u/%d/user-%d\"></head><body>"
+            "<span>My Stories <span class=badge>3</span></span><span>Favorite Stories <span class=badge>%d</span></span>"
+            "<span>Favorite Authors <span class=badge>20</span></span>%s<table>%s</table></body></html>"
+            % (user_id, user_id, FAVOURITE_STORIES, favourites, authors))
+
+
+def listing_page(medium, fandom):
+    """Returns a fandom listing with 25 stories."""
+    stories = ''.join(_storylist_entry(100 + i) for i in range(25))
+    return ("<!DOCTYPE html><html><head><title>%s</title></head><body>%s</body></html>"
+            % (html.escape('%s/%s' % (medium, fandom)), stories))
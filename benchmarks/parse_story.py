@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the story page metadata extraction (Story.parse_source).
+
+Compares the current extractor with the BeautifulSoup based one it replaced, on saved story pages:
+
+    python benchmarks/parse_story.py saved/s_1234.html saved/s_5678.html
+
+Without pages a synthetic story page shaped like fanfiction.net's is used.
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime
+from timeit import Timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bs4
+import file_converter  # imported first, it sets up fanfiction_net_api
+from fanfiction_net_api import Story
+
+import fixtures
+
+
+def legacy_parse(story, source, scratch):
+    """The extraction as it was before the compiled extractor, including the debug copy of the page it wrote."""
+    story.timestamp = datetime.now()
+    soup = bs4.BeautifulSoup(source, 'html.parser')
+    story.author_id = int(re.search(r"var\s+userid\s*=\s*(\d+);", source).group(1))
+    story.title = re.search(r"var\s+title\s*=\s*'(.+)';", source).group(1).replace('+', ' ')
+    fandom_chunk = soup.find('div', id='pre_story_links').find_all('a')[-1].get_text().replace('Crossover', '')
+    story.fandoms = [fandom.strip() for fandom in fandom_chunk.split('+')]
+    with open(scratch, 'w') as f:
+        f.write(source)
+    descr = re.search(r'Rated:(.+?)</div>', source.replace('\n', ' ')).group(0)
+    tokens = [token.strip() for token in re.sub(r'<.*?>', '', descr).split('-')]
+
+    int_tokens = {'Chapters: ': 'chapter_count', 'Words: ': 'word_count', 'Reviews: ': 'reviews',
+                  'Favs: ': 'favs', 'Follows: ': 'followers'}
+    date_tokens = {'Updated: ': 'date_updated', 'Published: ': 'date_published'}
+
+    def first_key(f, d):
+        for key in d:
+            if f(key):
+                return key
+        return None
+
+    # Rating, language, genre and id tokens skipped, the genre and completion checks cost next to nothing
+    for token in tokens[3:-1]:
+        int_k = first_key(lambda s: token.startswith(s), int_tokens)
+        date_k = first_key(lambda s: token.startswith(s), date_tokens)
+        if int_k is not None:
+            setattr(story, int_tokens[int_k], int(token[len(int_k):].replace(',', '')))
+        elif date_k is not None:
+            try:
+                setattr(story, date_tokens[date_k], datetime.strptime(token[len(date_k):], '%m/%d/%Y'))
+            except ValueError:
+                setattr(story, date_tokens[date_k], datetime.now())
+        else:
+            story.characters = [c.translate(str.maketrans('', '', '[]')).strip() for c in token.split(',')]
+
+
+def rate(function, number):
+    """Returns the calls of function per second, best of three runs."""
+    return number / min(Timer(function).repeat(repeat=3, number=number))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('pages', nargs='*', help='Saved story pages (html files)')
+    parser.add_argument('-n', '--number', type=int, default=200, help='Parses per run')
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = []
+        for path in args.pages:
+            with open(path, encoding='utf-8') as f:
+                pages.append((os.path.basename(path), f.read()))
+    else:
+        pages = [('synthetic', fixtures.story_page(fixtures.SIZES['medium']['story_id']))]
+
+    with tempfile.TemporaryDirectory() as directory:
+        scratch = os.path.join(directory, 'source')
+        print('%-24s %10s %14s %14s %8s' % ('page', 'size', 'legacy/s', 'current/s', 'speedup'))
+        for name, source in pages:
+            story = Story(id=1)
+            before = rate(lambda: legacy_parse(story, source, scratch), args.number)
+            after = rate(lambda: story.parse_source(source), args.number)
+            print('%-24s %9dK %14.1f %14.1f %7.1fx' % (name[:24], len(source) // 1024, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
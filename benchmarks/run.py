@@ -0,0 +1,203 @@
+"""
+Throughput benchmarks against a local stand-in of fanfiction.net.
+
+Every stage is measured for every story size in a fresh interpreter, so peak RSS belongs to that stage alone. Wall
+and CPU time come from an untraced run, allocations from a second run under tracemalloc. Results are printed and saved
+as JSON named after the current commit, pass an earlier file to --compare to see regressions:
+
+    python benchmarks/run.py --sizes small medium
+    python benchmarks/run.py --compare bench-1a2b3c4.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from time import perf_counter, process_time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import fixtures
+
+STAGES = ['download_data', 'chapters', 'reviews', 'user', 'convert_to_epub', 'write_epub', 'read_epub', 'read_epub_lazy']
+
+
+def _book(size):
+    """Builds the book of a story from fixtures, without any request."""
+    from ebooklib import epub
+
+    book = epub.EpubBook()
+    book.set_identifier(str(size['story_id']))
+    book.set_title('A Story Title %d' % size['story_id'])
+    book.set_language('en')
+    chapters = []
+    for number in range(1, size['chapters'] + 1):
+        chapter = epub.EpubHtml(title='%d. Chapter title %d' % (number, number), file_name='chapter_%d.xhtml' % number,
+                                lang='en')
+        chapter.content = '<h1>Chapter %d</h1>%s' % (number, fixtures.chapter_text(number, size['paragraphs']))
+        book.add_item(chapter)
+        chapters.append(chapter)
+    book.toc = chapters
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    book.spine = ['nav'] + chapters
+    return book
+
+
+def _stage(name, size, directory):
+    """Prepares a stage and returns the function running it once."""
+    import file_converter
+    import fanfiction_net_api as api
+    from ebooklib import epub
+
+    story_id = size['story_id']
+    if name == 'download_data':
+        return lambda: api.Story(story_id).download_data()
+    if name == 'chapters':
+        story = api.Story(story_id)
+        story.download_data()
+        return lambda: [chapter.text for chapter in api.Chapter.prefetch(story.get_chapter_list())]
+    if name == 'reviews':
+        return lambda: list(api.ReviewsGenerator(story_id))
+    if name == 'user':
+        return lambda: api.User(id=story_id).download_data()
+    if name == 'convert_to_epub':
+        os.chdir(directory)
+        return lambda: file_converter.Converter(story_id, cache=None).convert_to_epub()
+    if name == 'write_epub':
+        path = os.path.join(directory, 'book.epub')
+        book = _book(size)
+        return lambda: epub.write_epub(path, book, {'workers': file_converter.EPUB_WRITE_WORKERS})
+    if name == 'read_epub':
+        path = os.path.join(directory, 'book.epub')
+        epub.write_epub(path, _book(size), {})
+        return lambda: epub.read_epub(path)
+    if name == 'read_epub_lazy':
+        path = os.path.join(directory, 'book.epub')
+        epub.write_epub(path, _book(size), {})
+        return lambda: epub.read_epub(path, {'lazy': True}).close()
+    raise ValueError('Unknown stage %s' % name)
+
+
+def measure(name, size_name):
+    """Measures a stage in the current interpreter, returns the result record."""
+    size = fixtures.SIZES[size_name]
+    with tempfile.TemporaryDirectory() as directory:
+        run = _stage(name, size, directory)
+        gc.collect()
+        wall, cpu = perf_counter(), process_time()
+        run()
+        wall, cpu = perf_counter() - wall, process_time() - cpu
+        max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        run = _stage(name, size, directory)
+        gc.collect()
+        tracemalloc.start()
+        run()
+        _, alloc_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'stage': name, 'size': size_name, 'wall': wall, 'cpu': cpu, 'max_rss_kb': max_rss_kb,
+            'alloc_peak_bytes': alloc_peak}
+
+
+def _git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                         universal_newlines=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO_DIR) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def _child_env(root):
+    env = dict(os.environ)
+    env.update({
+        'FANFICTION_ROOT': root,
+        'PYTHONPATH': os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')])),
+        # Measure the code, not the politeness towards the site or the caches
+        'HOST_REQUEST_DELAY': '0',
+        'UPSTREAM_RATE': '1000000',
+        'UPSTREAM_BURST': '1000000',
+        'PAGE_CACHE_DIR': '',
+        'EPUB_CACHE_DIR': '',
+    })
+    return env
+
+
+def _compare(results, path):
+    with open(path) as f:
+        previous = json.load(f)
+    before = {(r['stage'], r['size']): r for r in previous['results']}
+    print('\nCompared with %s (%s)' % (previous['commit'], path))
+    print('%-16s %-7s %10s %10s' % ('stage', 'size', 'wall', 'rss'))
+    for result in results:
+        old = before.get((result['stage'], result['size']))
+        if old:
+            print('%-16s %-7s %9.2fx %9.2fx' % (result['stage'], result['size'], result['wall'] / old['wall'],
+                                                result['max_rss_kb'] / old['max_rss_kb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmarks against a local stand-in of fanfiction.net')
+    parser.add_argument('--sizes', nargs='+', choices=sorted(fixtures.SIZES), default=['small', 'medium', 'large'])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--pages', help='Directory of recorded pages served instead of the synthetic ones')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds the stand-in holds back every response')
+    parser.add_argument('--output', help='JSON file of the results, bench-<commit>.json by default')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--measure', nargs=2, metavar=('STAGE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # Child process, the record is the last line of output
+        result = measure(*args.measure)
+        print(json.dumps(result))
+        return
+
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, 'standin.py')]
+    if args.pages:
+        command += ['--pages', args.pages]
+    if args.latency:
+        command += ['--latency', str(args.latency)]
+    standin = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        root = standin.stdout.readline().strip()
+        env = _child_env(root)
+        results = []
+        print('%-16s %-7s %10s %10s %12s %14s' % ('stage', 'size', 'wall s', 'cpu s', 'peak rss MB', 'alloc peak MB'))
+        for size in args.sizes:
+            for stage in args.stages:
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--measure', stage, size],
+                                                 env=env, universal_newlines=True)
+                result = json.loads(output.strip().splitlines()[-1])
+                results.append(result)
+                print('%-16s %-7s %10.3f %10.3f %12.1f %14.1f' % (
+                    stage, size, result['wall'], result['cpu'], result['max_rss_kb'] / 1024.0,
+                    result['alloc_peak_bytes'] / 1024.0 / 1024.0))
+    finally:
+        standin.terminate()
+        standin.wait()
+
+    commit = _git_commit()
+    report = {'commit': commit, 'created': datetime.now().isoformat(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'results': results}
+    output = args.output or 'bench-%s.json' % commit
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Saved %s' % output)
+
+    if args.compare:
+        _compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
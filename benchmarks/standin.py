@@ -0,0 +1,97 @@
+"""
+Local HTTP stand-in for fanfiction.net.
+
+Serves recorded pages from a directory when there is one for the requested path (<pages>/<path>/index.html, e.g.
+pages/s/1234/2/index.html) and synthetic pages from fixtures otherwise. Point the library at it with FANFICTION_ROOT:
+
+    python benchmarks/standin.py --port 8000 &
+    FANFICTION_ROOT=http://127.0.0.1:8000 python -c "..."
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures
+
+_ROUTES = [
+    (re.compile(r'^/s/(\d+)(?:/(\d+))?'), lambda m: fixtures.story_page(int(m.group(1)), int(m.group(2) or 1))),
+    (re.compile(r'^/r/(\d+)(?:/(\d+))?(?:/(\d+))?'),
+     lambda m: fixtures.review_page(int(m.group(1)), int(m.group(2) or 0), int(m.group(3) or 1))),
+    (re.compile(r'^/u/(\d+)'), lambda m: fixtures.user_page(int(m.group(1)))),
+    (re.compile(r'^/(\w+)/([^/?]+)/'), lambda m: fixtures.listing_page(m.group(1), m.group(2))),
+]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, Nagle's algorithm would hold the body back for a delayed ACK
+    disable_nagle_algorithm = True
+    pages = None
+    latency = 0
+
+    def _page(self):
+        path = self.path.split('?', 1)[0]
+        if self.pages:
+            recorded = os.path.join(self.pages, path.strip('/'), 'index.html')
+            if os.path.isfile(recorded):
+                with open(recorded, encoding='utf-8') as f:
+                    return f.read()
+        for regex, page in _ROUTES:
+            match = regex.match(path)
+            if match:
+                return page(match)
+        return None
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        page = self._page()
+        if page is None:
+            self.send_error(404)
+            return
+        body = page.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0, pages=None, latency=0):
+    """
+    Creates the stand-in server, call serve_forever() on it to handle requests.
+    :param port: The port to listen on, a free one by default.
+    :param pages: Directory of recorded pages.
+    :param latency: Seconds every response is held back, to model the round trip to the real site.
+    :return: The server, its address is server.server_address.
+    """
+    handler = type('Handler', (_Handler,), {'pages': pages, 'latency': latency})
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local HTTP stand-in for fanfiction.net')
+    parser.add_argument('--port', type=int, default=0, help='Port to listen on, a free one by default')
+    parser.add_argument('--pages', help='Directory of recorded pages')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds every response is held back')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.pages, args.latency)
+    # The root url is the first line of output, the benchmark runner reads it
+    print('http://%s:%d' % server.server_address, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
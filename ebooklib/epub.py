@@ -15,12 +15,17 @@
 # along with EbookLib.  If not, see <http://www.gnu.org/licenses/>.
 
 import zipfile
+import zlib
+import contextlib
+import copy
+import time
 import six
 import logging
 import uuid
 import posixpath as zip_path
 import os.path
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from urllib.parse import unquote
@@ -31,7 +36,8 @@ from lxml import etree
 
 import ebooklib
 
-from ebooklib.utils import parse_string, parse_html_string, guess_type
+from ebooklib.utils import parse_string, parse_html_string, guess_type, read_raw_zip_entry, write_raw_zip_entry, \
+    MappedFile
 
 
 # Version of EPUB library
@@ -109,6 +115,11 @@ class EpubException(Exception):
 
 # Items
 
+# content of an item which was not read from the archive yet
+_UNREAD = object()
+# raised for content which isn't an html document, such documents are written empty
+_PARSE_ERRORS = (etree.LxmlError, ValueError, TypeError)
+
 
 class EpubItem(object):
     """
@@ -127,12 +138,75 @@ class EpubItem(object):
         self.id = uid
         self.file_name = file_name
         self.media_type = media_type
+        # (archive, member name) the content is read from, for items of lazily read books
+        self._source = None
         self.content = content
         self.is_linear = True
         self.manifest = manifest
 
         self.book = None
 
+    def _renamed(self):
+        # the lookups of the book which indexed this item are out of date, it reindexes on its next lookup
+        book = getattr(self, '_indexed_by', None)
+        if book is not None:
+            book._index_stale = True
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+        self._renamed()
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+    @file_name.setter
+    def file_name(self, value):
+        self._file_name = value
+        self._renamed()
+
+    @property
+    def media_type(self):
+        return self._media_type
+
+    @media_type.setter
+    def media_type(self, value):
+        self._media_type = value
+        self._renamed()
+
+    @property
+    def content(self):
+        "Content of the item. Items of lazily read books read it from the archive on first use."
+        return self._read_content()
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._source = None
+
+    def _set_source(self, archive, name):
+        # content is read from the archive member when it is first needed
+        self._content = _UNREAD
+        self._source = (archive, name)
+
+    def _read_content(self):
+        if self._content is _UNREAD:
+            archive, name = self._open_source()
+            self._content = archive.read(name)
+        return self._content
+
+    def _open_source(self):
+        # returns (archive, name) of the unread content, raises once the book was closed
+        archive, name = self._source
+        if archive.fp is None:
+            raise EpubException(-1, 'The book is closed, %s can no longer be read' % name)
+        return archive, name
+
     def get_id(self):
         """
         Returns unique identifier for this item.
@@ -235,6 +309,9 @@ class EpubHtml(EpubItem):
     _template_name = 'chapter'
 
     def __init__(self, uid=None, file_name='', media_type='', content=None, title='', lang=None, direction=None):
+        self._content = None
+        self._html_tree = None
+
         super(EpubHtml, self).__init__(uid, file_name, media_type, content)
 
         self.title = title
@@ -244,6 +321,45 @@ class EpubHtml(EpubItem):
         self.links = []
         self.properties = []
 
+    @property
+    def content(self):
+        """
+        HTML of the document. If the parsed tree returned by get_html_tree may have been changed since, the tree is
+        serialized again.
+        """
+        if self._content is None and self._html_tree is not None:
+            self._content = etree.tostring(self._html_tree, pretty_print=True, encoding='utf-8')
+        return self._read_content()
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._source = None
+        self._html_tree = None
+
+    def get_html_tree(self):
+        """
+        Returns the content parsed as lxml HTML tree. The tree is parsed once and shared, plugins change it in place
+        instead of parsing and serializing the content again. Raises the parser exception if the content can not be
+        parsed.
+
+        :Returns:
+          Returns the html root element of the document.
+        """
+        if self._html_tree is None:
+            self._html_tree = parse_html_string(self._read_content())
+        # the caller may change the tree, content has to be serialized from it again
+        self._content = None
+        self._source = None
+
+        return self._html_tree
+
+    def _get_tree(self):
+        # returns (tree, shared): the cached tree if there is one, else a new parse of the content
+        if self._html_tree is not None:
+            return self._html_tree, True
+        return parse_html_string(self._read_content()), False
+
     def is_chapter(self):
         """
         Returns if this document is chapter or not.
@@ -329,8 +445,8 @@ class EpubHtml(EpubItem):
         """
 
         try:
-            html_tree = parse_html_string(self.content)
-        except:
+            html_tree, _ = self._get_tree()
+        except _PARSE_ERRORS:
             return ''
 
         html_root = html_tree.getroottree()
@@ -362,7 +478,7 @@ class EpubHtml(EpubItem):
           Returns content of this document.
         """
 
-        tree = parse_string(self.book.get_template(self._template_name))
+        tree = self.book.get_template_tree(self._template_name)
         tree_root = tree.getroot()
 
         tree_root.set('lang', self.lang or self.book.language)
@@ -372,8 +488,8 @@ class EpubHtml(EpubItem):
         #  <meta charset="utf-8" />
 
         try:
-            html_tree = parse_html_string(self.content)
-        except:
+            html_tree, shared = self._get_tree()
+        except _PARSE_ERRORS:
             return ''
 
         html_root = html_tree.getroottree()
@@ -411,7 +527,8 @@ class EpubHtml(EpubItem):
         body = html_tree.find('body')
         if body is not None:
             for i in body.getchildren():
-                _body.append(i)
+                # the cached tree stays intact, a tree parsed just for this call can give its elements away
+                _body.append(copy.deepcopy(i) if shared else i)
 
         tree_str = etree.tostring(tree, pretty_print=True, encoding='utf-8', xml_declaration=True)
 
@@ -518,8 +635,18 @@ class EpubBook(object):
     def reset(self):
         "Initialises all needed variables to default values"
 
+        # reader of a lazily read book, its archive is open until close()
+        self._reader = None
+
         self.metadata = {}
         self.items = []
+        # lookups of the items by id, file name, type and media type, kept in sync by add_item, remove_item and
+        # replace_item, and rebuilt after an item was renamed
+        self._items_by_id = {}
+        self._items_by_href = {}
+        self._items_by_type = {}
+        self._items_by_media_type = {}
+        self._index_stale = False
         self.spine = []
         self.guide = []
         self.toc = []
@@ -542,6 +669,7 @@ class EpubBook(object):
             'chapter': CHAPTER_XML,
             'cover': COVER_XML
         }
+        self._template_trees = {}
 
         self.add_metadata('OPF', 'generator', '', {
             'name': 'generator', 'content': 'Ebook-lib %s' % '.'.join([str(s) for s in VERSION])
@@ -667,6 +795,21 @@ class EpubBook(object):
         else:
             self.add_metadata(namespace, name, value, others)
 
+    def close(self):
+        """
+        Closes the archive of a book which was read with option lazy. Content of its items which was not read yet
+        can't be read after that. Does nothing for other books.
+        """
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def add_item(self, item):
         """
         Add additional item to the book. If not defined, media type and chapter id will be defined
@@ -700,9 +843,124 @@ class EpubBook(object):
 
         item.book = self
         self.items.append(item)
+        self._index_item(item)
+
+        return item
+
+    def remove_item(self, item):
+        """
+        Removes item from the book. Entries of the spine pointing at the item are removed too.
+
+        :Args:
+          - item: Item instance
+
+        :Returns:
+          Returns removed item.
+        """
+        self.items.remove(item)
+        self._unindex_item(item)
+        self.spine = [entry for entry in self.spine if not self._is_spine_entry(entry, item)]
+        item.book = None
 
         return item
 
+    def replace_item(self, old_item, new_item):
+        """
+        Puts new item in place of old item, in the items and in the spine. If not defined, media type and id of the
+        old item are used for the new item.
+
+        :Args:
+          - old_item: Item instance which is in the book
+          - new_item: Item instance which replaces it
+
+        :Returns:
+          Returns new item.
+        """
+        position = next(i for i, item in enumerate(self.items) if item is old_item)
+
+        if not new_item.media_type:
+            new_item.media_type = old_item.media_type
+        if not new_item.get_id():
+            new_item.id = old_item.get_id()
+
+        for index, key in ((self._items_by_id, old_item.get_id()), (self._items_by_href, old_item.get_name())):
+            if index.get(key) is old_item:
+                del index[key]
+        self.items[position] = new_item
+        new_item.book = self
+        self._index_names(new_item)
+
+        for index, old_key, new_key in ((self._items_by_type, old_item.get_type(), new_item.get_type()),
+                                        (self._items_by_media_type, old_item.media_type, new_item.media_type)):
+            items = index.get(old_key, [])
+            found = next((i for i, itm in enumerate(items) if itm is old_item), None)
+            if old_key == new_key and found is not None:
+                items[found] = new_item
+            else:
+                index[old_key] = [itm for itm in items if itm is not old_item]
+                # keep the items of the new type in the order of the book
+                same_type = set(id(itm) for itm in index.get(new_key, []))
+                index[new_key] = [itm for itm in self.items if itm is new_item or id(itm) in same_type]
+        old_item.book = None
+        if getattr(old_item, '_indexed_by', None) is self:
+            old_item._indexed_by = None
+
+        for i, entry in enumerate(self.spine):
+            if entry is old_item:
+                self.spine[i] = new_item
+            elif isinstance(entry, tuple) and entry[0] is old_item:
+                self.spine[i] = (new_item,) + tuple(entry[1:])
+
+        return new_item
+
+    @staticmethod
+    def _is_spine_entry(entry, item):
+        if isinstance(entry, tuple):
+            entry = entry[0]
+        return entry is item or entry == item.get_id()
+
+    def _index_names(self, item):
+        # first item wins, like the scan through all items did. Renaming the item marks the index stale from now on.
+        item._indexed_by = self
+        self._items_by_id.setdefault(item.get_id(), item)
+        self._items_by_href.setdefault(item.get_name(), item)
+
+    def _index_item(self, item):
+        self._index_names(item)
+        self._items_by_type.setdefault(item.get_type(), []).append(item)
+        self._items_by_media_type.setdefault(item.media_type, []).append(item)
+
+    def _unindex_item(self, item):
+        for index, key, get_key in ((self._items_by_id, item.get_id(), EpubItem.get_id),
+                                    (self._items_by_href, item.get_name(), EpubItem.get_name)):
+            if index.get(key) is item:
+                del index[key]
+                other = next((itm for itm in self.items if itm is not item and get_key(itm) == key), None)
+                if other is not None:
+                    index[key] = other
+
+        for index, key in ((self._items_by_type, item.get_type()), (self._items_by_media_type, item.media_type)):
+            items = index.get(key, [])
+            index[key] = [itm for itm in items if itm is not item]
+
+        if getattr(item, '_indexed_by', None) is self:
+            item._indexed_by = None
+
+    def _sync_index(self):
+        # renamed items and items appended to the list directly, without add_item, are indexed on the next lookup
+        if self._index_stale or sum(len(items) for items in self._items_by_type.values()) != len(self.items):
+            self._reindex()
+
+    def _reindex(self):
+        self._index_stale = False
+        self._items_by_id = {}
+        self._items_by_href = {}
+        self._items_by_type = {}
+        self._items_by_media_type = {}
+
+        for item in self.items:
+            self._index_item(item)
+
     def get_item_with_id(self, uid):
         """
         Returns item for defined UID.
@@ -715,11 +973,8 @@ class EpubBook(object):
         :Returns:
           Returns item object. Returns None if nothing was found.
         """
-        for item in self.get_items():
-            if item.id == uid:
-                return item
-
-        return None
+        self._sync_index()
+        return self._items_by_id.get(uid)
 
     def get_item_with_href(self, href):
         """
@@ -733,11 +988,8 @@ class EpubBook(object):
         :Returns:
           Returns item object. Returns None if nothing was found.
         """
-        for item in self.get_items():
-            if item.get_name() == href:
-                return item
-
-        return None
+        self._sync_index()
+        return self._items_by_href.get(href)
 
     def get_items(self):
         """
@@ -760,7 +1012,8 @@ class EpubBook(object):
         :Returns:
           Returns found items as tuple.
         """
-        return (item for item in self.items if item.get_type() == item_type)
+        self._sync_index()
+        return (item for item in self._items_by_type.get(item_type, []))
 
     def get_items_of_media_type(self, media_type):
         """
@@ -772,7 +1025,8 @@ class EpubBook(object):
         :Returns:
           Returns found items as tuple.
         """
-        return (item for item in self.items if item.media_type == media_type)
+        self._sync_index()
+        return (item for item in self._items_by_media_type.get(media_type, []))
 
     def set_template(self, name, value):
         """
@@ -804,6 +1058,23 @@ class EpubBook(object):
         """
         return self.templates.get(name)
 
+    def get_template_tree(self, name):
+        """
+        Returns the template parsed as a new tree, which the caller may change. Every template is parsed only once.
+
+        :Args:
+          - name: template name
+
+        :Returns:
+          Parsed template as lxml ElementTree.
+        """
+        template = self.get_template(name)
+        cached = self._template_trees.get(name)
+        if cached is None or cached[0] != template:
+            cached = self._template_trees[name] = (template, parse_string(template))
+
+        return copy.deepcopy(cached[1])
+
     def add_prefix(self, name, uri):
         """
         Appends custom prefix to be added to the content.opf document
@@ -818,6 +1089,49 @@ class EpubBook(object):
         self.prefixes.append('%s: %s' % (name, uri))
 
 
+@contextlib.contextmanager
+def _untimed(stage):
+    yield
+
+
+def _deflate_entry(name, data, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Compresses data the way ZipFile.writestr does, so the entry can be appended with write_raw_zip_entry.
+
+    :Returns:
+      Returns tuple (ZipInfo, bytes).
+    """
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+
+    zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    zinfo.compress_size = len(compressed)
+
+    return zinfo, compressed
+
+
+def _copy_entry(name, archive, member):
+    """
+    Reads the still compressed member of another archive, so it can be appended under name with write_raw_zip_entry.
+
+    :Returns:
+      Returns tuple (ZipInfo, bytes).
+    """
+    zinfo, data = read_raw_zip_entry(archive, member)
+
+    zinfo = copy.copy(zinfo)
+    zinfo.filename = name
+
+    return zinfo, data
+
+
 class EpubWriter(object):
     DEFAULT_OPTIONS = {
         'epub2_guide': True,
@@ -836,7 +1150,7 @@ class EpubWriter(object):
             self.options.update(options)
 
     def process(self):
-        # should cache this html parsing so we don't do it for every plugin
+        # html plugins share the parsed tree of each document, see EpubHtml.get_html_tree
         for plg in self.options.get('plugins', []):
             if hasattr(plg, 'before_write'):
                 plg.before_write(self.book)
@@ -847,6 +1161,18 @@ class EpubWriter(object):
                     if hasattr(plg, 'html_before_write'):
                         plg.html_before_write(self.book, item)
 
+    def _write_mimetype(self):
+        # written by hand so the entry never gets a data descriptor, even when the output is not seekable
+        data = six.b('application/epub+zip')
+
+        zinfo = zipfile.ZipInfo('mimetype', date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.external_attr = 0o600 << 16
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        zinfo.file_size = zinfo.compress_size = len(data)
+
+        write_raw_zip_entry(self.out, zinfo, data)
+
     def _write_container(self):
         container_xml = CONTAINER_XML % {'folder_name': self.book.FOLDER_NAME}
         self.out.writestr(CONTAINER_PATH, container_xml)
@@ -1203,36 +1529,217 @@ class EpubWriter(object):
 
         return tree_str
 
+    def _write_item(self, item):
+        if isinstance(item, (EpubNcx, EpubNav)) or item.file_name in self.options.get('copy_items', ()):
+            # keep the order of the entries, items rendered by the pool go first
+            self._flush_pending()
+
+        if isinstance(item, EpubNcx):
+            self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_ncx())
+        elif isinstance(item, EpubNav):
+            self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_nav(item))
+        elif item.file_name in self.options.get('copy_items', ()):
+            # copy compressed bytes from the source book, content of the item is not used at all
+            zinfo, data = read_raw_zip_entry(self._source, '%s/%s' % (self.book.FOLDER_NAME, item.file_name))
+            write_raw_zip_entry(self.out, zinfo, data)
+        elif item.manifest:
+            self._write_content('%s/%s' % (self.book.FOLDER_NAME, item.file_name), item)
+        else:
+            self._write_content('%s' % item.file_name, item)
+
+    def _write_content(self, name, item):
+        if item._source is not None:
+            # item of a lazily read book which was not changed, its compressed bytes are copied as they are
+            self._append_entry(_copy_entry, name, *item._open_source())
+            self._release(item)
+            return
+
+        if self._pool is None:
+            # option timer is called with the stage name and returns a context manager around the stage
+            timer = self.options.get('timer') or _untimed
+            with timer('render'):
+                content = item.get_content()
+            self._release(item)
+            with timer('compress'):
+                self.out.writestr(name, content)
+            return
+
+        self._append_entry(self._render_entry, name, item)
+
+    def _append_entry(self, function, *args):
+        "Appends the entry function(*args) returns as (ZipInfo, bytes), it runs in the pool if there is one."
+        if self._pool is None:
+            write_raw_zip_entry(self.out, *function(*args))
+            return
+
+        self._pending.append(self._pool.submit(function, *args))
+        # append what is ready, and don't let more than a few entries per worker pile up in memory
+        while self._pending and (self._pending[0].done() or len(self._pending) > 2 * self._workers):
+            write_raw_zip_entry(self.out, *self._pending.popleft().result())
+
+    def _render_entry(self, name, item):
+        # runs in the pool, rendering and compressing without touching the archive
+        timer = self.options.get('timer') or _untimed
+        with timer('render'):
+            content = item.get_content()
+        self._release(item)
+        with timer('compress'):
+            return _deflate_entry(name, content, self.options.get('compresslevel', zlib.Z_DEFAULT_COMPRESSION))
+
+    def _release(self, item):
+        "Called once the content of item has been rendered."
+        pass
+
+    def _flush_pending(self):
+        "Appends the entries the pool is still working on, in the order they were submitted."
+        while self._pending:
+            write_raw_zip_entry(self.out, *self._pending.popleft().result())
+
     def _write_items(self):
         for item in self.book.get_items():
-            if isinstance(item, EpubNcx):
-                self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_ncx())
-            elif isinstance(item, EpubNav):
-                self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_nav(item))
-            elif item.manifest:
-                self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), item.get_content())
-            else:
-                self.out.writestr('%s' % item.file_name, item.get_content())
+            self._write_item(item)
+
+    def _open(self):
+        reader = self.book._reader
+        if reader is not None and isinstance(self.file_name, six.string_types) and \
+                isinstance(reader.file_name, six.string_types) and os.path.exists(self.file_name) and \
+                os.path.samefile(self.file_name, reader.file_name):
+            raise EpubException(-1, "Can't write a lazily read book over the file it is read from")
+
+        # items listed in option copy_items are copied as they are from the epub in option copy_from
+        self._source = None
+        if self.options.get('copy_items'):
+            self._source = zipfile.ZipFile(self.options['copy_from'], 'r')
+
+        # with option workers > 1 items are rendered and compressed (at option compresslevel) by a pool of threads
+        self._workers = self.options.get('workers') or 1
+        self._pool = ThreadPoolExecutor(max_workers=self._workers) if self._workers > 1 else None
+        self._pending = deque()
 
-    def write(self):
         # check for the option allowZip64
+        # file_name can also be a file object, which doesn't have to be seekable
         self.out = zipfile.ZipFile(self.file_name, 'w', zipfile.ZIP_DEFLATED)
-        self.out.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self._write_mimetype()
 
         self._write_container()
-        self._write_opf_file()
-        self._write_items()
+
+    def _close(self):
+        if self._pool is not None:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._pool.shutdown()
+            self._pool = None
+
+        if self._source is not None:
+            self._source.close()
+            self._source = None
 
         self.out.close()
 
+    def write(self):
+        self._open()
+
+        try:
+            self._write_opf_file()
+            self._write_items()
+            self._flush_pending()
+        finally:
+            self._close()
+
+
+class EpubStreamWriter(EpubWriter):
+    """
+    Writes the book while it is being built.
+
+    Items passed to write_item are compressed into the archive right away and their content is released, so only
+    their manifest data stays in memory. With option workers they are rendered and compressed in the background
+    instead, and appended to the archive in the order they were passed. OPF, NCX and navigation documents are generated by close() together with
+    the items which were added to the book but not written yet.
+
+    >>> writer = EpubStreamWriter('book.epub', book)
+    >>> writer.open()
+    >>> for chapter in chapters:
+    ...     writer.write_item(chapter)
+    >>> book.toc = chapters
+    >>> writer.close()
+    """
+
+    def __init__(self, name, book, options=None):
+        super(EpubStreamWriter, self).__init__(name, book, options)
+
+        self._written = set()
+
+    def open(self):
+        "Creates the archive. Plugins get before_write called here, before any item is written."
+        for plg in self.options.get('plugins', []):
+            if hasattr(plg, 'before_write'):
+                plg.before_write(self.book)
+
+        self._open()
+
+    def write_item(self, item):
+        """
+        Adds item to the book, if it is not already added, and writes it to the archive.
+
+        :Args:
+          - item: Item instance
+        """
+        if item.book is not self.book:
+            self.book.add_item(item)
+
+        if isinstance(item, EpubHtml):
+            for plg in self.options.get('plugins', []):
+                if hasattr(plg, 'html_before_write'):
+                    plg.html_before_write(self.book, item)
+
+        self._write_item(item)
+        self._written.add(item.file_name)
+
+    def _release(self, item):
+        # only the manifest data is needed from now on
+        item.content = None
+
+    def _write_items(self):
+        for item in self.book.get_items():
+            if item.file_name not in self._written:
+                self.write_item(item)
+
+    def close(self):
+        "Writes OPF, NCX, navigation and the remaining items and closes the archive."
+        try:
+            self._flush_pending()
+            self._write_opf_file()
+            self._write_items()
+            self._flush_pending()
+        finally:
+            self._close()
+
 
 class EpubReader(object):
+    """
+    Reads a book from an EPUB file.
+
+    By default content of all items is read into memory and the archive is closed when the book is loaded. With
+    option lazy only container, OPF and NCX (or navigation document) are read, so metadata, spine and table of
+    contents are available right away. The archive stays open, memory mapped if it is a file on disk, and each item
+    reads its content from it on first use. Close the book once it is not needed anymore.
+
+    Writing a lazily read book copies the compressed bytes of the items whose content was not changed, only changed
+    items and OPF, NCX and navigation document are generated again. Changing metadata of a big book is cheap that way.
+
+    >>> book = read_epub('book.epub', {'lazy': True})
+    >>> book.set_unique_metadata('DC', 'title', 'New title')
+    >>> write_epub('new.epub', book)
+    >>> book.close()
+    """
     DEFAULT_OPTIONS = {}
 
     def __init__(self, epub_file_name, options=None):
         self.file_name = epub_file_name
         self.book = EpubBook()
         self.zf = None
+        self._file = None
 
         self.opf_file = ''
         self.opf_dir = ''
@@ -1262,6 +1769,23 @@ class EpubReader(object):
         # Raises KeyError
         return self.zf.read(name)
 
+    def close(self):
+        "Closes the archive, items of a lazily read book which were not read yet can't be read anymore."
+        if self.zf is not None:
+            self.zf.close()
+            self.zf = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _load_content(self, item, name):
+        if self.options.get('lazy'):
+            # raises KeyError for missing members right away, like read_file
+            self.zf.getinfo(name)
+            item._set_source(self.zf, name)
+        else:
+            item.content = self.read_file(name)
+
     def _load_container(self):
         meta_inf = self.read_file('META-INF/container.xml')
         tree = parse_string(meta_inf)
@@ -1353,37 +1877,37 @@ class EpubReader(object):
             if media_type == 'application/x-dtbncx+xml':
                 ei = EpubNcx(uid=r.get('id'), file_name=unquote(r.get('href')))
 
-                ei.content = self.read_file(zip_path.join(self.opf_dir, ei.file_name))
+                self._load_content(ei, zip_path.join(self.opf_dir, ei.file_name))
             elif media_type == 'application/xhtml+xml':
                 if 'nav' in properties:
                     ei = EpubNav(uid=r.get('id'), file_name=unquote(r.get('href')))
 
-                    ei.content = self.read_file(zip_path.join(self.opf_dir, r.get('href')))
+                    self._load_content(ei, zip_path.join(self.opf_dir, r.get('href')))
                 elif 'cover' in properties:
                     ei = EpubCoverHtml()
 
-                    ei.content = self.read_file(zip_path.join(self.opf_dir, unquote(r.get('href'))))
+                    self._load_content(ei, zip_path.join(self.opf_dir, unquote(r.get('href'))))
                 else:
                     ei = EpubHtml()
 
                     ei.id = r.get('id')
                     ei.file_name = unquote(r.get('href'))
                     ei.media_type = media_type
-                    ei.content = self.read_file(zip_path.join(self.opf_dir, ei.get_name()))
+                    self._load_content(ei, zip_path.join(self.opf_dir, ei.get_name()))
                     ei.properties = properties
             elif media_type in IMAGE_MEDIA_TYPES:
                 if 'cover-image' in properties:
                     ei = EpubCover(uid=r.get('id'), file_name=unquote(r.get('href')))
 
                     ei.media_type = media_type
-                    ei.content = self.read_file(zip_path.join(self.opf_dir, ei.get_name()))
+                    self._load_content(ei, zip_path.join(self.opf_dir, ei.get_name()))
                 else:
                     ei = EpubImage()
 
                     ei.id = r.get('id')
                     ei.file_name = unquote(r.get('href'))
                     ei.media_type = media_type
-                    ei.content = self.read_file(zip_path.join(self.opf_dir, ei.get_name()))
+                    self._load_content(ei, zip_path.join(self.opf_dir, ei.get_name()))
             else:
                 # different types
                 ei = EpubItem()
@@ -1392,7 +1916,7 @@ class EpubReader(object):
                 ei.file_name = unquote(r.get('href'))
                 ei.media_type = media_type
 
-                ei.content = self.read_file(zip_path.join(self.opf_dir, ei.get_name()))
+                self._load_content(ei, zip_path.join(self.opf_dir, ei.get_name()))
 
             self.book.add_item(ei)
 
@@ -1498,19 +2022,38 @@ class EpubReader(object):
             if nav_item:
                 self._parse_nav(nav_item.content, zip_path.dirname(nav_item.file_name))
 
-    def _load(self):
+    def _open_archive(self):
+        source = self.file_name
+        if self.options.get('lazy') and isinstance(source, six.string_types):
+            try:
+                self._file = source = MappedFile(source)
+            except (ValueError, EnvironmentError):
+                # empty files and files which can't be mapped are read as usual
+                pass
+
         try:
-            self.zf = zipfile.ZipFile(self.file_name, 'r', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+            self.zf = zipfile.ZipFile(source, 'r', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
         except zipfile.BadZipfile as bz:
             raise EpubException(0, 'Bad Zip file')
         except zipfile.LargeZipFile as bz:
             raise EpubException(1, 'Large Zip file')
 
-        # 1st check metadata
-        self._load_container()
-        self._load_opf_file()
+    def _load(self):
+        try:
+            self._open_archive()
+
+            # 1st check metadata
+            self._load_container()
+            self._load_opf_file()
+        except:
+            self.close()
+            raise
 
-        self.zf.close()
+        if self.options.get('lazy'):
+            # items read their content from the archive, the book closes it
+            self.book._reader = self
+        else:
+            self.close()
 
 
 # WRITE
@@ -1522,7 +2065,7 @@ def write_epub(name, book, options=None):
     >>> ebooklib.write_epub('book.epub', book)
 
     :Args:
-      - name: file name for the output file
+      - name: file name for the output file, or a writable file object
       - book: instance of EpubBook
       - options: extra opions as dictionary (optional)
     """
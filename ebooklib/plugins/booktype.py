@@ -15,7 +15,6 @@
 # along with EbookLib.  If not, see <http://www.gnu.org/licenses/>.
 
 from ebooklib.plugins.base import BasePlugin
-from ebooklib.utils import parse_html_string
 
 class BooktypeLinks(BasePlugin):
     NAME = 'Booktype Links'
@@ -32,7 +31,7 @@ class BooktypeLinks(BasePlugin):
             from urllib.parse import urlparse, urljoin
 
         try:
-            tree = parse_html_string(chapter.content)
+            tree = chapter.get_html_tree()
         except:
             return
 
@@ -68,8 +67,6 @@ class BooktypeLinks(BasePlugin):
                     if _link.get('name') != None:
                         _link.set('id', _link.get('name'))
                         etree.strip_attributes(_link, 'name')
-                    
-        chapter.content = etree.tostring(tree, pretty_print=True, encoding='utf-8')
             
 
 
@@ -86,7 +83,7 @@ class BooktypeFootnotes(BasePlugin):
         from ebooklib import epub
 
         try:
-            tree = parse_html_string(chapter.content)
+            tree = chapter.get_html_tree()
         except:
             return
 
@@ -115,5 +112,3 @@ class BooktypeFootnotes(BasePlugin):
             old_footnote = body.xpath('//ol[@id="InsertNote_NoteList"]')
             if len(old_footnote) > 0:
                 body.remove(old_footnote[0])
-            
-        chapter.content = etree.tostring(tree, pretty_print=True, encoding='utf-8')        
@@ -15,7 +15,6 @@
 # along with EbookLib.  If not, see <http://www.gnu.org/licenses/>.
 
 from ebooklib.plugins.base import BasePlugin
-from ebooklib.utils import parse_html_string
 
 class SourceHighlighter(BasePlugin):    
     def __init__(self):
@@ -30,7 +29,7 @@ class SourceHighlighter(BasePlugin):
         from ebooklib import epub
 
         try:
-            tree = parse_html_string(chapter.content)
+            tree = chapter.get_html_tree()
         except:
             return
 
@@ -64,5 +63,4 @@ class SourceHighlighter(BasePlugin):
 
         if had_source:
             chapter.add_link(href="style/code.css", rel="stylesheet", type="text/css")
-            chapter.content = etree.tostring(tree, pretty_print=True, encoding='utf-8')        
 
@@ -17,7 +17,6 @@
 import six
 
 from ebooklib.plugins.base import BasePlugin
-from ebooklib.utils import parse_html_string
 
 # TODO:
 #   - should also look for the _required_ elements
@@ -46,7 +45,7 @@ class SyntaxPlugin(BasePlugin):
         from lxml import etree
 
         try:
-            tree = parse_html_string(chapter.content)
+            tree = chapter.get_html_tree()
         except:
             return
 
@@ -225,6 +224,4 @@ class SyntaxPlugin(BasePlugin):
                         if _attr not in ATTRIBUTES_GLOBAL:
                             del _item.attrib[_attr]
 
-        chapter.content = etree.tostring(tree, pretty_print=True, encoding='utf-8', xml_declaration=True)
-        
-        return chapter.content
+        return True
@@ -14,8 +14,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with EbookLib.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import io
 import mimetypes
+import mmap
+import struct
+import zipfile
 
 from lxml import etree
 
@@ -58,3 +62,93 @@ def guess_type(extenstion):
         mimetype_initialised = True
 
     return mimetypes.guess_type(extenstion)
+
+
+def read_raw_zip_entry(zf, name):
+    """
+    Returns ZipInfo and still compressed content of a member of a zip file opened for reading.
+
+    :Args:
+      - zf: instance of zipfile.ZipFile
+      - name: name of the member
+
+    :Returns:
+      Returns tuple (ZipInfo, bytes).
+    """
+    zinfo = zf.getinfo(name)
+
+    with zf._lock:
+        zf.fp.seek(zinfo.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, zf.fp.read(zipfile.sizeFileHeader))
+        zf.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], io.SEEK_CUR)
+        data = zf.fp.read(zinfo.compress_size)
+
+    return zinfo, data
+
+
+def write_raw_zip_entry(zf, zinfo, data):
+    """
+    Appends an already compressed member to a zip file opened for writing. CRC, sizes and compression type
+    are taken from zinfo, data is written as it is.
+
+    :Args:
+      - zf: instance of zipfile.ZipFile
+      - zinfo: ZipInfo describing the member
+      - data: compressed content of the member
+    """
+    zinfo = copy.copy(zinfo)
+    # sizes are known up front, so the member never needs a data descriptor
+    zinfo.flag_bits &= ~0x08
+
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+
+        zf._writecheck(zinfo)
+        zf._didModify = True
+
+        zf.fp.write(zinfo.FileHeader())
+        zf.fp.write(data)
+
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        zf.start_dir = zf.fp.tell()
+
+
+class MappedFile(object):
+    """
+    Read only file object over a memory mapped file, for zipfile.ZipFile. Reading members goes straight to the page
+    cache instead of through file buffers, and nothing is read before it is needed.
+
+    :Args:
+      - name: path of the file
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._file = open(name, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._map.read()
+        return self._map.read(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def tell(self):
+        return self._map.tell()
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,139 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from time import time
+
+# Directory of the cache, an empty value disables caching
+EPUB_CACHE_DIR = os.environ.get('EPUB_CACHE_DIR', os.path.join('cache', 'epub'))
+# Maximum size of the cache on disk in bytes, least recently used books are removed above it
+EPUB_CACHE_MAX_BYTES = int(os.environ.get('EPUB_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+_UNSAFE_FILENAME_REGEX = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+_VERSION_DIR_REGEX = re.compile(r'^(\d+)-(\d+)$')
+
+
+def safe_filename(title):
+    """Returns title usable as a file name on every platform."""
+    return _UNSAFE_FILENAME_REGEX.sub('_', title).strip(' .') or 'story'
+
+
+class EpubCache(object):
+    """
+    Cache of converted epub files.
+
+    A book is stored as <directory>/<story id>/<update timestamp>-<chapter count>/<title>.epub, so a story gets a new
+    entry as soon as its metadata shows a change. The access time of an epub is the moment it was last served, which is
+    what the LRU eviction orders by.
+
+    Attributes:
+        directory   (str):  Absolute path of the directory holding the cached books, a relative directory is taken
+                            from the working directory the cache is created in
+        max_bytes   (int):  Size above which least recently used books are removed
+    """
+
+    def __init__(self, directory, max_bytes=EPUB_CACHE_MAX_BYTES):
+        # Paths handed out must not depend on the working directory of their user, e.g. Flask's send_file
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(story):
+        """
+        :param story: A Story with downloaded data.
+        :return: The cache key of the current version of the story.
+        """
+        return int(story.id), int(story.date_updated.timestamp()), story.chapter_count
+
+    @staticmethod
+    def etag(key):
+        """Returns the entity tag of the book stored under key."""
+        return '%d-%d-%d' % key
+
+    def _dir(self, key):
+        story_id, updated, chapter_count = key
+        return os.path.join(self.directory, str(story_id), '%d-%d' % (updated, chapter_count))
+
+    def get(self, key):
+        """
+        Returns the path of the book stored under key or None.
+        """
+        directory = self._dir(key)
+        try:
+            names = [name for name in os.listdir(directory) if name.endswith('.epub')]
+        except OSError:
+            return None
+        if not names:
+            return None
+        path = os.path.join(directory, names[0])
+        try:
+            os.utime(path, (time(), os.stat(path).st_mtime))
+        except OSError:
+            return None
+        return path
+
+    def versions(self, story_id):
+        """
+        Returns the keys of every cached version of a story, most recently updated first.
+        """
+        try:
+            names = os.listdir(os.path.join(self.directory, str(story_id)))
+        except OSError:
+            return []
+        keys = []
+        for name in names:
+            match = _VERSION_DIR_REGEX.match(name)
+            if match:
+                keys.append((int(story_id), int(match.group(1)), int(match.group(2))))
+        return sorted(keys, reverse=True)
+
+    @contextmanager
+    def store(self, key, title):
+        """
+        Context manager yielding the file name the book stored under key should be written to.
+        The book becomes visible to get() only once the block exits without an exception.
+
+        >>> with cache.store(key, story.title) as filename:
+        ...     epub.write_epub(filename, book)
+        """
+        directory = self._dir(key)
+        parent = os.path.dirname(directory)
+        os.makedirs(parent, exist_ok=True)
+        # Unique across the threads and the processes building the same version
+        tmp_directory = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', suffix='.tmp', dir=parent)
+        try:
+            yield os.path.join(tmp_directory, '%s.epub' % safe_filename(title))
+            try:
+                os.rename(tmp_directory, directory)
+            except OSError:
+                # Another build of the same version finished first, keep that one
+                pass
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        """Removes least recently used books until the cache takes less than max_bytes."""
+        with self._lock:
+            books = []
+            for dirpath, _, filenames in os.walk(self.directory):
+                if dirpath.endswith('.tmp'):
+                    continue
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        books.append((path, os.stat(path)))
+                    except OSError:
+                        pass
+            size = sum(stat.st_size for _, stat in books)
+            for path, stat in sorted(books, key=lambda book: book[1].st_atime):
+                if size <= self.max_bytes:
+                    break
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                size -= stat.st_size
+
+
+epub_cache = EpubCache(EPUB_CACHE_DIR) if EPUB_CACHE_DIR else None
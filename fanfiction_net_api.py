@@ -1,49 +1,106 @@
-import re, requests, bs4, unicodedata
-from datetime import timedelta, date, datetime
-from time import time
+import re, requests, bs4, html
+import lxml.html
+from requests.adapters import HTTPAdapter
+# The urllib3 requests decodes with, its own vendored copy in older releases of requests
+from requests.packages.urllib3.util.request import ACCEPT_ENCODING
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta, date, datetime, timezone
+from sys import intern
+from time import time, sleep, monotonic
+from urllib.parse import urlparse
 import plistlib
 from file_converter import *
 import file_converter
 import os
 import constants
+from page_cache import PageCache, PAGE_CACHE_DIR
+from rate_limiter import RateLimiter, backoff
+from metrics import metrics
 
 # Constants
-root = 'https://www.fanfiction.net'
+# Site the pages are downloaded from, pointed at a local stand-in by the benchmarks
+root = os.environ.get('FANFICTION_ROOT', 'https://www.fanfiction.net').rstrip('/')
+
+# Number of chapters fetched at once by Story.get_chapters
+CHAPTER_FETCH_WORKERS = int(os.environ.get('CHAPTER_FETCH_WORKERS', 4))
+# Number of review pages fetched at once by ReviewsGenerator
+REVIEW_FETCH_WORKERS = int(os.environ.get('REVIEW_FETCH_WORKERS', 4))
+# Number of story pages fetched at once by fetch_story_metadata
+METADATA_FETCH_WORKERS = int(os.environ.get('METADATA_FETCH_WORKERS', 8))
+# Minimum number of seconds between two requests to the same host
+HOST_REQUEST_DELAY = float(os.environ.get('HOST_REQUEST_DELAY', 0.2))
+# Number of keep-alive connections kept open per host by the shared session
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+# Seconds to wait for the server to connect and to send data
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 30))
+# Number of times a request is retried after a 429/503 response or a connection error
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 4))
+# Responses slower than this many seconds make the rate limiter back off
+SLOW_RESPONSE_SECONDS = float(os.environ.get('SLOW_RESPONSE_SECONDS', 5))
 
 # REGEX MATCHES
 
 # STORY REGEX
-_STORYID_REGEX = r"var\s+storyid\s*=\s*(\d+);"
-_CHAPTER_REGEX = r"var\s+chapter\s*=\s*(\d+);"
-_CHAPTERS_REGEX = r"Chapters:\s*(\d+)\s*"
-_WORDS_REGEX = r"Words:\s*([\d,]+)\s*"
-_TITLE_REGEX = r"var\s+title\s*=\s*'(.+)';"
-_DATEP_REGEX = r"Published:\s*<span.+?='(\d+)'>"
-_DATEU_REGEX = r"Updated:\s*<span.+?='(\d+)'>"
+_STORYID_REGEX = re.compile(r"var\s+storyid\s*=\s*(\d+);")
+_CHAPTER_REGEX = re.compile(r"var\s+chapter\s*=\s*(\d+);")
+_CHAPTERS_REGEX = re.compile(r"Chapters:\s*(\d+)\s*")
+_WORDS_REGEX = re.compile(r"Words:\s*([\d,]+)\s*")
+_TITLE_REGEX = re.compile(r"var\s+title\s*=\s*'(.+)';")
+_DATEP_REGEX = re.compile(r"Published:\s*<span.+?='(\d+)'>")
+_DATEU_REGEX = re.compile(r"Updated:\s*<span.+?='(\d+)'>")
 
 # USER REGEX
-_USERID_REGEX = r"var\s+userid\s*=\s*(\d+);"
-_AUTHOR_REGEX = r"href='/u/\d+/(.+?)'"
-_USERID_URL_EXTRACT = r".*/u/(\d+)"
-_USERNAME_REGEX = r"<link rel=\"canonical\" href=\"//www.fanfiction.net/u/\d+/(.+)\">"
-_USER_STORY_COUNT_REGEX = r"My Stories\s*<span class=badge>(\d+)<"
-_USER_FAVOURITE_COUNT_REGEX = r"Favorite Stories\s*<span class=badge>(\d+)<"
-_USER_FAVOURITE_AUTHOR_COUNT_REGEX = r"Favorite Authors\s*<span class=badge>(\d+)<"
+_USERID_REGEX = re.compile(r"var\s+userid\s*=\s*(\d+);")
+_AUTHOR_REGEX = re.compile(r"href='/u/\d+/(.+?)'")
+_USERID_URL_EXTRACT = re.compile(r".*/u/(\d+)")
+_USERNAME_REGEX = re.compile(r"<link rel=\"canonical\" href=\"//www.fanfiction.net/u/\d+/(.+)\">")
+_USER_STORY_COUNT_REGEX = re.compile(r"My Stories\s*<span class=badge>(\d+)<")
+_USER_FAVOURITE_COUNT_REGEX = re.compile(r"Favorite Stories\s*<span class=badge>(\d+)<")
+_USER_FAVOURITE_AUTHOR_COUNT_REGEX = re.compile(r"Favorite Authors\s*<span class=badge>(\d+)<")
 
 # Useful for generating a review URL later on
-_STORYTEXTID_REGEX = r"var\s+storytextid\s*=\s*storytextid=(\d+);"
+_STORYTEXTID_REGEX = re.compile(r"var\s+storytextid\s*=\s*storytextid=(\d+);")
+# Matches the storyid, chapter and storytextid variables of a chapter page at once
+_CHAPTER_VARIABLES_REGEX = re.compile(r"var\s+(storyid|chapter|storytextid)\s*=\s*(?:storytextid=)?(\d+);")
+# Story id and chapter number in the url of a chapter
+_CHAPTER_URL_REGEX = re.compile(r"/s/(\d+)(?:/(\d+))?")
+# Chapter navigation of a story page and the titles in it, tags and attributes in any case like an html parser
+_CHAPTER_SELECT_REGEX = re.compile(r"<select[^>]*name=.?chapter\b[^>]*>(.*?)</select>", re.I | re.DOTALL)
+_CHAPTER_OPTION_REGEX = re.compile(r"<option[^>]*>([^<]*)", re.I | re.DOTALL)
+# Start of the chapter text, everything about the story is above it
+_STORYTEXT_MARKER = re.compile(r"<div[^>]*id=.?storytext", re.I)
+# Elements whose text isn't displayed
+_INVISIBLE_TAGS = {'style', 'script', 'head', 'title'}
 
 # REGEX that used to parse reviews page
-_REVIEW_COMPLETE_INFO_REGEX = r"img class=.*?</div"
-_REVIEW_USER_NAME_REGEX = r"> *([^< ][^<]*)<"
-_REVIEW_CHAPTER_REGEX = r"<small style=[^>]*>([^<]*)<"
-_REVIEW_TIME_REGEX = r"<span data[^>]*>([^<]*)<"
-_REVIEW_TEXT_REGEX = r"<div[^>]*>([^<]*)<"
+_REVIEW_COMPLETE_INFO_REGEX = re.compile(r"img class=.*?</div", re.DOTALL)
+_REVIEW_USER_NAME_REGEX = re.compile(r"> *([^< ][^<]*)<")
+_REVIEW_CHAPTER_REGEX = re.compile(r"<small style=[^>]*>([^<]*)<")
+_REVIEW_TIME_REGEX = re.compile(r"<span data[^>]*>([^<]*)<")
+_REVIEW_XUTIME_REGEX = re.compile(r"data-xutime=['\"]?(\d+)")
+_REVIEW_TEXT_REGEX = re.compile(r"<div[^>]*>([^<]*)<")
+# Pagination of a reviews page, the 'Last' link is missing on the last page
+_REVIEW_LAST_PAGE_REGEX = re.compile(r"<a href=['\"]/r/\d+/\d+/(\d+)/['\"]>Last</a>")
+_REVIEW_PAGE_LINK_REGEX = re.compile(r"href=['\"]/r/\d+/\d+/(\d+)/['\"]")
 
 # Used to parse the attributes which aren't directly contained in the
 # JavaScript and hence need to be parsed manually
-_NON_JAVASCRIPT_REGEX = r'Rated:(.+?)</div>'
-_HTML_TAG_REGEX = r'<.*?>'
+_NON_JAVASCRIPT_REGEX = re.compile(r'Rated:(.+?)</div>', re.DOTALL)
+_HTML_TAG_REGEX = re.compile(r'<.*?>')
+
+# Fandom links above the story and the text of a link
+_PRE_STORY_LINKS_REGEX = re.compile(r"<div id=.?pre_story_links.?>(.*?)</div>", re.DOTALL)
+_LINK_TEXT_REGEX = re.compile(r"<a[^>]*>([^<]*)</a>")
+# Dates in descriptions, replaced by their timestamp
+_XUTIME_SPAN_REGEX = re.compile(r"<span data-xutime=['\"]?(\d+)['\"]?>[^<]*</span>")
+
+# Attributes set from the 'Label: value' tokens of a story description
+_INT_TOKENS = {'Chapters': 'chapter_count', 'Words': 'word_count', 'Reviews': 'reviews', 'Favs': 'favs',
+               'Follows': 'followers'}
+_DATE_TOKENS = {'Updated': 'date_updated', 'Published': 'date_published'}
+_CHARACTER_BRACKETS = str.maketrans('', '', '[]')
 
 # Needed to properly decide if a token contains a genre or a character name
 _GENRES = [
@@ -54,21 +111,31 @@ _GENRES = [
 ]
 
 # TEMPLATES
-_STORY_URL_TEMPLATE = 'https://www.fanfiction.net/s/%d'
-_CHAPTER_URL_TEMPLATE = 'https://www.fanfiction.net/s/%d/%d'
-_USERID_URL_TEMPLATE = 'https://www.fanfiction.net/u/%d'
+_STORY_URL_TEMPLATE = root + '/s/%d'
+_CHAPTER_URL_TEMPLATE = root + '/s/%d/%d'
+_USERID_URL_TEMPLATE = root + '/u/%d'
 
 _DATE_COMPARISON = date(1970, 1, 1)
 
+# Functions called with every Story downloaded by download_data or parsed from a story list and every User downloaded,
+# see metadata_index.MetadataIndex.attach
+parsed_hooks = []
+
+
+def _parsed(item):
+    """Hands a freshly parsed story or user to the parsed_hooks."""
+    for hook in parsed_hooks:
+        hook(item)
+
 
 def _parse_string(regex, source):
-    """Returns first group of matched regular expression as string."""
-    return re.search(regex, source).group(1)
+    """Returns first group of matched compiled regular expression as string."""
+    return regex.search(source).group(1)
 
 
 def _parse_integer(regex, source):
-    """Returns first group of matched regular expression as integer."""
-    match = re.search(regex, source).group(1)
+    """Returns first group of matched compiled regular expression as integer."""
+    match = regex.search(source).group(1)
     match = match.replace(',', '')
     return int(match)
 
@@ -84,41 +151,173 @@ def _unescape_javascript_string(string_):
     return string_.replace("\\'", "'").replace('\\"', '"').replace('\\\\', '\\')
 
 
-def _visible_filter(element):
-    if element.parent.name in ['style', 'script', '[document]', 'head', 'title']:
-        return False
-    element = unicodedata.normalize('NFKD', element).encode('ascii', 'ignore')
-    if re.match(r'<!--.*-->', str(element)):
-        return False
-    return True
+_session = None
+_session_lock = threading.RLock()
+
+
+def configure_session(pool_size=None, timeout=None):
+    """
+    (Re)creates the session shared by every request of this module.
+    :param pool_size: The number of connections kept open per host, HTTP_POOL_SIZE by default.
+    :param timeout: The per-request timeout in seconds, HTTP_TIMEOUT by default.
+    :return: The new session.
+    """
+    global _session, HTTP_POOL_SIZE, HTTP_TIMEOUT
+    if pool_size is not None:
+        HTTP_POOL_SIZE = pool_size
+    if timeout is not None:
+        HTTP_TIMEOUT = timeout
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(constants.headers)
+    # Only advertise the encodings urllib3 can actually decode (br needs the brotli package)
+    session.headers['accept-encoding'] = ACCEPT_ENCODING
+
+    with _session_lock:
+        old, _session = _session, session
+    if old is not None:
+        old.close()
+    return session
+
+
+def get_session():
+    """
+    :return: The shared keep-alive session, created on first use.
+    """
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                return configure_session()
+    return _session
 
 
-def _get_int_value_from_token(token, prefix):
-    if not token.startswith(prefix):
-        raise ValueError("int token doesn't starts with given prefix")
-    else:
-        return int(token[len(prefix):].replace(',', ''))
+# Cache of story, chapter and review pages, None when disabled
+page_cache = PageCache(PAGE_CACHE_DIR) if PAGE_CACHE_DIR else None
+# Limits the requests of all threads of the process to what the site tolerates, see rate_limiter.stats()
+rate_limiter = RateLimiter()
 
 
-def _get_date_value_from_token(token, prefix):
-    if not token.startswith(prefix):
-        raise ValueError("date token doesn't starts with given prefix")
-    else:
+def _fetch(url, cached=False, valid_since=None, delay=0, **kwargs):
+    """
+    Downloads url through the shared session and returns the page source.
+    Requests wait for rate_limiter and are retried with backoff on 429/503 responses and connection errors.
+    :param cached: Whether the page may be served from and stored in page_cache.
+    :param valid_since: Timestamp of the last known change of the page, see PageCache.get.
+    :param delay: Politeness delay applied before going to the network, see _wait_for_host.
+    """
+    if cached and page_cache is not None:
+        source = page_cache.get(url, valid_since)
+        if source is not None:
+            metrics.inc('fanfiction_fetch_requests_total', source='cache')
+            return source
+
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    for attempt in range(HTTP_RETRIES + 1):
+        _wait_for_host(url, delay)
+        rate_limiter.acquire()
+        start = monotonic()
+        try:
+            response = get_session().get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            rate_limiter.throttled()
+            if attempt == HTTP_RETRIES:
+                raise
+            metrics.inc('fanfiction_fetch_retries_total')
+            sleep(backoff(attempt))
+            continue
+
+        elapsed = monotonic() - start
+        metrics.observe('fanfiction_fetch_seconds', elapsed)
+        metrics.inc('fanfiction_fetch_requests_total', source='site')
+        metrics.inc('fanfiction_fetch_bytes_total', len(response.content))
+
+        if response.status_code in (429, 503):
+            rate_limiter.throttled(_retry_after(response))
+            if attempt == HTTP_RETRIES:
+                response.raise_for_status()
+            metrics.inc('fanfiction_fetch_retries_total')
+            sleep(backoff(attempt))
+            continue
+
+        if elapsed > SLOW_RESPONSE_SECONDS:
+            rate_limiter.throttled()
+        else:
+            rate_limiter.succeeded()
+        break
+
+    source = response.text
+    if cached and page_cache is not None and response.status_code == 200:
         try:
-            return datetime.strptime(token[len(prefix):], '%m/%d/%Y')
-        except ValueError:
-            return datetime.now()
+            page_cache.put(url, source)
+        except OSError as e:
+            # The cache is best effort, the page was downloaded anyway
+            print("Can't cache %s: %s" % (url, e))
+    return source
+
+
+def _retry_after(response):
+    """Returns the seconds of the Retry-After header of response, or None."""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
 
 
-def _get_key_of_first_positive(f, d):
+_host_next_request = {}
+_host_lock = threading.Lock()
+
+
+def _wait_for_host(url, delay):
+    """
+    Blocks until the next request slot for the host of url is available.
+    Slots are handed out at least `delay` seconds apart, so concurrent callers are spaced out as well.
+    """
+    if delay <= 0:
+        return
+    host = urlparse(url).netloc
+    with _host_lock:
+        now = monotonic()
+        slot = max(now, _host_next_request.get(host, now))
+        _host_next_request[host] = slot + delay
+    if slot > now:
+        sleep(slot - now)
+
+
+def _visible_texts(element):
+    """Yields the displayed text nodes below an lxml element in document order, skipping scripts and comments."""
+    if not isinstance(element.tag, str) or element.tag in _INVISIBLE_TAGS:
+        return
+    if element.text:
+        yield element.text
+    for child in element:
+        yield from _visible_texts(child)
+        if child.tail:
+            yield child.tail
+
+
+def _description_tokens(descr):
+    """
+    Splits the html of a story description into its '-' separated tokens, without tags and with entities decoded
+    like the text of the description. Dates are replaced by their data-xutime timestamp.
     """
-    returns key k of first item in l for which f(k) == True
-    or None
+    descr = _XUTIME_SPAN_REGEX.sub(r'\1', descr)
+    return [html.unescape(token).strip() for token in _HTML_TAG_REGEX.sub('', descr).split('-')]
+
+
+def _get_date_value_from_token(value):
+    """
+    Returns the date of a description token value, a timestamp or (in old pages) a m/d/Y date, as an aware datetime in
+    UTC. Naive datetimes would be taken as UTC by werkzeug, e.g. for Last-Modified, but hold the server's local time.
     """
-    for key, value in d.items():
-        if f(key) == True:
-            return key
-    return None
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value), timezone.utc)
+    try:
+        return datetime.strptime(value, '%m/%d/%Y').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return datetime.now(timezone.utc)
 
 
 class Story(object):
@@ -149,35 +348,41 @@ class Story(object):
             favs (int):             The number of user which has this story in favorite list
             followers (int):        The number of users who follow the story
             complete (bool):        True if the story is complete, else False.
+            chapter_titles [str]:   The titles of the chapters, empty for a single chapter story.
         """
         self.id = id
         if id is None:
             raise ValueError("id can't be None")
 
     def download_data(self):
-        self.timestamp = datetime.now()
         url = _STORY_URL_TEMPLATE % int(self.id)
-        source = requests.get(url)
-        source = source.text
-        self._soup = bs4.BeautifulSoup(source, 'html.parser')
+        source = _fetch(url, cached=True)
+        print('download_data({})'.format(self.id))
+        with metrics.timer('fanfiction_parse_seconds', page='story'):
+            self.parse_source(source)
+        _parsed(self)
 
+    def parse_source(self, source):
+        """
+        Fills the story from the source of its page, download_data without the download.
+        :param source: The html of the first page of the story.
+        """
+        self.timestamp = datetime.now()
         self.author_id = _parse_integer(_USERID_REGEX, source)
         self.title = _unescape_javascript_string(_parse_string(_TITLE_REGEX, source).replace('+', ' '))
-        print('download_data({})'.format(self.id))
-        fandom_chunk = self._soup.find('div', id='pre_story_links').find_all('a')[-1].get_text().replace('Crossover',
-                                                                                                         '')
+
+        links = _PRE_STORY_LINKS_REGEX.search(source)
+        fandom_chunk = html.unescape(_LINK_TEXT_REGEX.findall(links.group(1))[-1]).replace('Crossover', '')
         self.fandoms = [fandom.strip() for fandom in fandom_chunk.split('+')]
 
-        del self._soup
+        select = _CHAPTER_SELECT_REGEX.search(source)
+        self.chapter_titles = [html.unescape(title) for title in _CHAPTER_OPTION_REGEX.findall(select.group(1))] \
+            if select else []
 
         # Tokens of information that aren't directly contained in the
         # JavaScript, need to manually parse and filter those
-        with open('source', 'w') as f:
-            f.write(source)
-        descr = re.search(_NON_JAVASCRIPT_REGEX, source.replace('\n', ' ')).group(0)
-        tokens = [token.strip() for token in
-                  re.sub(_HTML_TAG_REGEX, '', descr).split('-')]
-        self._parse_description(tokens)
+        descr = _NON_JAVASCRIPT_REGEX.search(source).group(0)
+        self._parse_description(_description_tokens(descr))
 
     def _parse_description(self, tokens):
         """
@@ -216,25 +421,20 @@ class Story(object):
 
         # except those there are 4 possible kind of tokens: tokens with int data, tokens with date data, story id token,
         # and token with characters/pairings
-        int_tokens = {'Chapters: ': 'chapter_count', 'Words: ': 'word_count', 'Reviews: ': 'reviews',
-                      'Favs: ': 'favs', 'Follows: ': 'followers'}
-        date_tokens = {'Updated: ': 'date_updated', 'Published: ': 'date_published'}
-
         for token in tokens:
-            int_k = _get_key_of_first_positive(lambda s: token.startswith(s), int_tokens)
-            date_k = _get_key_of_first_positive(lambda s: token.startswith(s), date_tokens)
-            if int_k is not None:
-                setattr(self, int_tokens[int_k], _get_int_value_from_token(token, int_k))
-            elif date_k is not None:
-                setattr(self, date_tokens[date_k], _get_date_value_from_token(token, date_k))
+            label, _, value = token.partition(':')
+            if label in _INT_TOKENS:
+                setattr(self, _INT_TOKENS[label], int(value.replace(',', '')))
+            elif label in _DATE_TOKENS:
+                setattr(self, _DATE_TOKENS[label], _get_date_value_from_token(value.strip()))
             else:
-                self.characters = [c.translate(str.maketrans('', '', '[]')).strip() for c in token.split(',')]
+                self.characters = [c.translate(_CHARACTER_BRACKETS).strip() for c in token.split(',')]
 
         # now we have to fill field which could be left empty
         if not hasattr(self, 'chapter_count'):
             self.chapter_count = 1
 
-        for field in int_tokens.values():
+        for field in _INT_TOKENS.values():
             if not hasattr(self, field):
                 setattr(self, field, 0)
 
@@ -254,20 +454,40 @@ class Story(object):
 
         self.author_id = _parse_integer(_USERID_URL_EXTRACT, str(story_chunk))
 
-        descr = story_chunk.find('div', {'class': 'z-padtop2 xgray'}).get_text()
-        self._parse_description([token.strip() for token in descr.split('-')])
+        descr = str(story_chunk.find('div', {'class': 'z-padtop2 xgray'}))
+        self._parse_description(_description_tokens(descr))
+        _parsed(self)
 
-    def get_chapters(self):
+    def get_chapters(self, workers=None, delay=None, first=1):
         """
         A generator for all chapters in the story.
+        Chapters are downloaded by a pool of `workers` threads but always yielded in order.
+        :param workers: The maximum number of chapters fetched at once, CHAPTER_FETCH_WORKERS by default.
+        :param delay: The minimum number of seconds between two requests, HOST_REQUEST_DELAY by default.
+        :param first: The number of the first chapter to fetch.
         :return: A generator to fetch chapter objects.
         """
         try:
-            for number in range(1, self.chapter_count + 1):
-                yield Chapter(story_id=self.id, chapter=number)
+            yield from Chapter.prefetch(self.get_chapter_list(first=first, delay=delay), workers=workers)
         except KeyboardInterrupt:
             print("!-- Stopped fetching chapters")
 
+    def get_chapter_list(self, first=1, delay=None):
+        """
+        Returns the chapters of the story as handles which are only downloaded when their text is needed.
+        Titles are taken from the story page, so listing them costs no request.
+        :param first: The number of the first chapter.
+        :param delay: The minimum number of seconds between two requests, HOST_REQUEST_DELAY by default.
+        :return: A list of chapter objects.
+        """
+        if delay is None:
+            delay = HOST_REQUEST_DELAY
+        updated = getattr(self, 'date_updated', None)
+        titles = getattr(self, 'chapter_titles', [])
+        return [Chapter(story_id=self.id, chapter=number, updated=updated, delay=delay,
+                        title=titles[number - 1] if number <= len(titles) else None)
+                for number in range(first, self.chapter_count + 1)]
+
     def get_user(self):
         """
         :return: The user object of the author of the story.
@@ -285,12 +505,14 @@ class Story(object):
         for attr in attrs:
             print("%12s\t%s" % (attr, getattr(self, attr)))
 
-    def get_reviews(self):
+    def get_reviews(self, workers=None, start_page=1):
         """
         A generator for all reviews in the story.
+        :param workers: The maximum number of pages fetched at once, REVIEW_FETCH_WORKERS by default.
+        :param start_page: The page of reviews to start from.
         :return: A generator to fetch reviews.
         """
-        return ReviewsGenerator(self.id)
+        return ReviewsGenerator(self.id, workers=workers, start_page=start_page)
 
     # def download(self, output='', message=True, ext=''):
     #     download(self, output=output, message=message, ext=ext)
@@ -300,47 +522,185 @@ class Story(object):
     chapters = property(get_chapters)
 
 
+StoryMetadata = namedtuple('StoryMetadata', [
+    'id', 'title', 'author_id', 'fandoms', 'rated', 'language', 'genre', 'characters', 'chapter_count', 'word_count',
+    'reviews', 'favs', 'followers', 'date_published', 'date_updated', 'complete', 'timestamp', 'error'])
+StoryMetadata.__doc__ = """
+Metadata of a story from fetch_story_metadata, with the attributes of Story of the same names. If the story couldn't
+be fetched or parsed only id is set, and error describes the failure.
+"""
+
+_METADATA_FIELDS = StoryMetadata._fields[1:-1]
+
+
+def _story_metadata(story_id, cached, delay):
+    """Downloads the page of a story and returns its StoryMetadata, failures are returned as the error."""
+    try:
+        source = _fetch(_STORY_URL_TEMPLATE % int(story_id), cached=cached, delay=delay)
+        with metrics.timer('fanfiction_parse_seconds', page='story'):
+            # Only the header is parsed, the chapter text below it is skipped
+            header = _STORYTEXT_MARKER.search(source)
+            story = Story(story_id)
+            story.parse_source(source[:header.start()] if header else source)
+    except Exception as e:
+        return StoryMetadata(story_id, *[None] * len(_METADATA_FIELDS), error='%s: %s' % (type(e).__name__, e))
+    return StoryMetadata(story_id, *[getattr(story, field) for field in _METADATA_FIELDS], error=None)
+
+
+def fetch_story_metadata(story_ids, workers=None, delay=None, cached=False):
+    """
+    Downloads the metadata of many stories, e.g. to refresh a watchlist.
+    Story pages are downloaded by a pool of `workers` threads under the shared rate limit, and only their header is
+    parsed. Records are yielded as soon as they are ready, so not in the order of story_ids. A story which can't be
+    fetched or parsed yields a record with its error instead of raising.
+    :param story_ids: An iterable of story ids.
+    :param workers: The maximum number of stories fetched at once, METADATA_FETCH_WORKERS by default.
+    :param delay: The minimum number of seconds between two requests, HOST_REQUEST_DELAY by default.
+    :param cached: Whether pages may come from the page cache.
+    :return: A generator of StoryMetadata records.
+    """
+    if workers is None:
+        workers = METADATA_FETCH_WORKERS
+    if delay is None:
+        delay = HOST_REQUEST_DELAY
+
+    story_ids = iter(story_ids)
+    if workers <= 1:
+        for story_id in story_ids:
+            yield _story_metadata(story_id, cached, delay)
+        return
+
+    # Keep at most `workers` stories in flight, ids are taken from the iterable as slots free up
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        try:
+            for story_id in story_ids:
+                pending.add(pool.submit(metrics.bind(_story_metadata), story_id, cached, delay))
+                if len(pending) >= workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 class ReviewsGenerator(object):
     """
-    Class that generates review in chronological order
+    Class that generates reviews in the order of the site, newest first
+
+    The first page tells how many pages of reviews there are. The following pages are downloaded by a pool of
+    `workers` threads and their reviews are yielded in order as soon as they and every page before them are loaded.
+    A crawl that was interrupted is resumed by passing finished_page + 1 as start_page.
+
     Attributes:
-        base_url            (int):      storys review url without specified page number
-        page_number         (int):      number of current review page
-        reviews_cache       List(str):  list of already downloaded  (and partially processed) reviews
-        skip_reviews_number (int):      length of already processed review from review_cache
+        story_id            (int):      story ID
+        base_url            (str):      storys review url without specified page number
+        workers             (int):      maximum number of pages fetched at once
+        delay               (float):    minimum number of seconds between two requests
+        cached              (bool):     whether pages may come from the page cache
+        start_page          (int):      first page of reviews generated
+        last_page           (int):      last page of reviews, read from the first page downloaded if not given
+        page_number         (int):      page of the review generated last
+        finished_page       (int):      last page whose reviews were all generated
     """
 
-    def __init__(self, story_id, chapter=0):
+    def __init__(self, story_id, chapter=0, workers=None, delay=None, start_page=1, last_page=None, cached=True):
         """
         If chapter unspecified then generator generates review for all chapters
+        :param workers: The maximum number of pages fetched at once, REVIEW_FETCH_WORKERS by default.
+        :param delay: The minimum number of seconds between two requests, HOST_REQUEST_DELAY by default.
+        :param cached: Whether pages may come from the page cache, turn it off to see the latest reviews.
+        :param start_page: The page to start from, e.g. to resume an earlier crawl.
+        :param last_page: The page to stop at, the last page of reviews by default.
         """
         self.story_id = story_id
         self.base_url = root + '/r/' + str(story_id) + '/' + str(chapter) + '/'
+        self.workers = REVIEW_FETCH_WORKERS if workers is None else workers
+        self.delay = HOST_REQUEST_DELAY if delay is None else delay
+        self.cached = cached
+        self.start_page = start_page
+        self.last_page = last_page
+        self.page_number = start_page - 1
+        self.finished_page = start_page - 1
 
     def __iter__(self):
-        self.page_number = 0
-        self.reviews_cache = []
-        self.skip_reviews_number = 0
+        self._reviews = self._generate()
         return self
 
     def __next__(self):
-        self.skip_reviews_number += 1
-        if len(self.reviews_cache) >= self.skip_reviews_number:
-            return Review(self.story_id, self.reviews_cache[self.skip_reviews_number - 1])
-
-        self.page_number += 1
-        page = self._downloadReviewPage(self.page_number)
-        self.reviews_cache = re.findall(_REVIEW_COMPLETE_INFO_REGEX, page, re.DOTALL)
-
-        if len(self.reviews_cache) == 0:
-            raise StopIteration
-
-        self.skip_reviews_number = 1
-        return Review(self.story_id, self.reviews_cache[0])
+        return next(self._reviews)
+
+    def _generate(self):
+        reviews, last_page = self._load_page(self.start_page)
+        if self.last_page is None:
+            self.last_page = last_page
+        yield from self._page_reviews(self.start_page, reviews)
+
+        pages = iter(range(self.start_page + 1, self.last_page + 1))
+        if self.workers <= 1:
+            for page in pages:
+                reviews, _ = self._load_page(page)
+                if not reviews:
+                    return
+                yield from self._page_reviews(page, reviews)
+            return
+
+        # Keep at most `workers` pages in flight, so a slow consumer doesn't buffer all the reviews
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for page in pages:
+                pending.append((page, pool.submit(metrics.bind(self._load_page), page)))
+                if len(pending) >= self.workers:
+                    break
+            try:
+                while pending:
+                    page, future = pending.popleft()
+                    reviews, _ = future.result()
+                    # Reviews were deleted since the first page was downloaded, there are fewer pages now
+                    if not reviews:
+                        return
+                    following = next(pages, None)
+                    if following is not None:
+                        pending.append((following, pool.submit(metrics.bind(self._load_page), following)))
+                    yield from self._page_reviews(page, reviews)
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def _page_reviews(self, page, reviews):
+        for review in reviews:
+            self.page_number = page
+            yield review
+        self.finished_page = page
+
+    def _load_page(self, page_number):
+        """
+        Downloads and parses a page of reviews.
+        :return: Tuple of the list of reviews on the page and the number of the last page.
+        """
+        source = self._downloadReviewPage(page_number)
+        with metrics.timer('fanfiction_parse_seconds', page='reviews'):
+            reviews = [Review(self.story_id, info) for info in _REVIEW_COMPLETE_INFO_REGEX.findall(source)]
+            last_page = _review_last_page(source, page_number)
+        return reviews, last_page
 
     def _downloadReviewPage(self, page_number):
         url = self.base_url + str(page_number) + '/'
-        return requests.get(url).text
+        return _fetch(url, cached=self.cached, delay=self.delay)
+
+
+def _review_last_page(source, page_number):
+    """Returns the number of the last page of reviews from the pagination of a reviews page."""
+    match = _REVIEW_LAST_PAGE_REGEX.search(source)
+    if match is not None:
+        return int(match.group(1))
+    # No 'Last' link on the last page itself
+    return max([page_number] + [int(page) for page in _REVIEW_PAGE_LINK_REGEX.findall(source)])
 
 
 class Review(object):
@@ -352,8 +712,13 @@ class Review(object):
         user_name   (str):  user name (or pseudonym for anonymous review)
         chapter     (str):  chapter name
         time_ago    (str):  how much time passed since review submit (format may be inconsistent with what you see in browser just because fanfiction.net sends different pages depend on do you download page from browser or from console/that library
+        timestamp   (int):  unix time of the review submit (may be None if the page doesn't say)
         text        (str):  review text
+
+    Crawls keep a lot of reviews around, so they have no instance dict and repeated strings (user name, chapter,
+    time) are interned. Use ReviewTable from review_table for millions of them.
     """
+    __slots__ = ('story_id', 'user_id', 'user_name', 'chapter', 'time_ago', 'timestamp', 'text')
 
     def __init__(self, story_id, unparsed_info):
         """
@@ -362,39 +727,65 @@ class Review(object):
         :param unparsed_info    (int):  string that contain the rest info
         """
         self.story_id = story_id
-        self.user_name = _parse_string(_REVIEW_USER_NAME_REGEX, unparsed_info)
-        self.chapter = _parse_string(_REVIEW_CHAPTER_REGEX, unparsed_info)
+        self.user_name = intern(_parse_string(_REVIEW_USER_NAME_REGEX, unparsed_info))
+        self.chapter = intern(_parse_string(_REVIEW_CHAPTER_REGEX, unparsed_info))
         self.text = _parse_string(_REVIEW_TEXT_REGEX, unparsed_info)
 
-        self.time_ago = _parse_string(_REVIEW_TIME_REGEX, unparsed_info)
+        time_ago = _parse_string(_REVIEW_TIME_REGEX, unparsed_info)
 
         # fanfiction.net provide strange format, instead of '8 hours ago' it show '8h'
         # so let's add ' ago' suffix if review submitted hours or minutes ago
-        if self.time_ago[-1] == 'h' or self.time_ago[-1] == 'm':
-            self.time_ago += ' ago'
+        if time_ago[-1] == 'h' or time_ago[-1] == 'm':
+            time_ago += ' ago'
+        self.time_ago = intern(time_ago)
+
+        match = _REVIEW_XUTIME_REGEX.search(unparsed_info)
+        self.timestamp = int(match.group(1)) if match is not None else None
 
-        if re.search(_USERID_URL_EXTRACT, unparsed_info) == None:
+        if _USERID_URL_EXTRACT.search(unparsed_info) == None:
             self.user_id = None
         else:
             self.user_id = _parse_integer(_USERID_URL_EXTRACT, unparsed_info)
 
+    @classmethod
+    def from_values(cls, story_id, user_id, user_name, chapter, time_ago, timestamp, text):
+        """
+        Creates a review from attributes which are already parsed, e.g. a row of a ReviewTable.
+        :return: The review.
+        """
+        review = cls.__new__(cls)
+        review.story_id = story_id
+        review.user_id = user_id
+        review.user_name = user_name
+        review.chapter = chapter
+        review.time_ago = time_ago
+        review.timestamp = timestamp
+        review.text = text
+        return review
+
 
 class Chapter(object):
-    def __init__(self, url=None, story_id=None, chapter=None):
+    def __init__(self, url=None, story_id=None, chapter=None, updated=None, delay=0, title=None):
         """ A single chapter in a fanfiction story, on fanfiction.net
 
+        Nothing is downloaded until an attribute of the page is read, or the chapter is passed to Chapter.prefetch.
+
         :param url: The url of the chapter.
         :param story_id: The story id of the story of the chapter.
         :param chapter: The chapter number of the story.
+        :param updated: The date_updated of the story, a cached page downloaded after it is reused.
+        :param delay: The minimum number of seconds since the previous request to the site.
+        :param title: The title of the chapter if it is already known, e.g. from the story page.
 
         Attributes:
+            url         (str):  The url of the chapter.
             story_id    (int):  Story ID
             number      (int):  Chapter number
-            story_text_id (int):    ?
-            title       (str):  Title of the chapter, or title of the story.
-            raw_text    (str):  The raw HTML of the story.
-            text_list   List(str):  List of unicode strings for each paragraph.
-            text        (str):  Visible text of the story.
+            story_text_id (int):    ?, loaded on first access.
+            title       (str):  Title of the chapter, or title of the story, loaded on first access if not given.
+            raw_text    (str):  The raw HTML of the story, loaded on first access.
+            text_list   List(str):  List of unicode strings for each paragraph, computed on first access.
+            text        (str):  Visible text of the story, computed on first access.
         """
 
         if url is None:
@@ -403,48 +794,140 @@ class Chapter(object):
             elif chapter is None:
                 print('Both a story id and chapter number must be provided')
             elif story_id and chapter:
-                url = _CHAPTER_URL_TEMPLATE % (story_id, chapter)
+                url = _CHAPTER_URL_TEMPLATE % (int(story_id), int(chapter))
 
-        source = requests.get(url)
-        source = source.text
-        self.story_id = _parse_integer(_STORYID_REGEX, source)
-        self.number = _parse_integer(_CHAPTER_REGEX, source)
-        self.story_text_id = _parse_integer(_STORYTEXTID_REGEX, source)
+        self.url = url
+        match = _CHAPTER_URL_REGEX.search(url)
+        self.story_id = int(match.group(1)) if match else None
+        self.number = int(match.group(2) or 1) if match else None
+        self._updated = updated
+        self._delay = delay
+        self._title = title
+        self._raw_text = None
+        self._story_text_id = None
+        self._text_list = None
+
+    @property
+    def loaded(self):
+        """True once the page of the chapter has been downloaded."""
+        return self._raw_text is not None
+
+    def load(self):
+        """
+        Downloads and parses the page of the chapter, unless it is already loaded.
+        :return: The chapter itself.
+        """
+        if self.loaded:
+            return self
 
-        soup = bs4.BeautifulSoup(source, 'html.parser')
-        select = soup.find('select', {'name': 'chapter'})
-        if select:
-            # There are multiple chapters available, use chapter's title
-            found = select.find('option', selected=True)
-            if found:
-                self.title = str(found).partition("<option value=\"")[0].split(">", 1)[1].split("<", 1)[0] #found[0].text #.split(None, 1)[1]
-        else:
-            # No multiple chapters, one-shot or only a single chapter released
-            # until now; for the lack of a proper chapter title use the story's
-            self.title = _unescape_javascript_string(_parse_string(_TITLE_REGEX, source)).decode()
-        soup = soup.find('div', id='storytext')
-        # Try to remove AddToAny share buttons
-        try:
-            soup.find('div', {'class': lambda class_: class_ and 'a2a_kit' in class_}).extract()
-        except AttributeError:
-            pass
-        # Normalize HTML tag attributes
-        for hr in soup('hr'):
-            del hr['size']
-            del hr['noshade']
+        valid_since = self._updated.timestamp() if self._updated is not None else None
+        source = _fetch(self.url, cached=True, valid_since=valid_since, delay=self._delay)
+        with metrics.timer('fanfiction_parse_seconds', page='chapter'):
+            self._parse(source)
+        return self
 
-        self.raw_text = soup.decode()
+    def _parse(self, source):
+        variables = dict(_CHAPTER_VARIABLES_REGEX.findall(source))
+        self.story_id = int(variables['storyid'])
+        self.number = int(variables['chapter'])
+        self._story_text_id = int(variables['storytextid'])
+
+        document = lxml.html.fromstring(source)
+        if self._title is None:
+            select = document.xpath('//select[@name="chapter"]')
+            if select:
+                # There are multiple chapters available, use chapter's title
+                found = select[0].xpath('option[@selected]')
+                if found:
+                    self._title = found[0].text
+            else:
+                # No multiple chapters, one-shot or only a single chapter released
+                # until now; for the lack of a proper chapter title use the story's
+                self._title = _unescape_javascript_string(_parse_string(_TITLE_REGEX, source))
+
+        storytext = document.get_element_by_id('storytext')
+        # Remove AddToAny share buttons
+        for share in storytext.xpath('.//div[contains(@class, "a2a_kit")]'):
+            share.drop_tree()
+        # Normalize HTML tag attributes
+        for hr in storytext.iter('hr'):
+            hr.attrib.pop('size', None)
+            hr.attrib.pop('noshade', None)
 
-        texts = soup.findAll(text=True)
-        self.text_list = list(filter(_visible_filter, texts))
-        self.text = '\n'.join(self.text_list)
+        self._raw_text = lxml.html.tostring(storytext, encoding='unicode', with_tail=False)
 
-    def get_reviews(self):
+    @staticmethod
+    def prefetch(chapters, workers=None):
+        """
+        Loads many chapters at once.
+        Pages are downloaded by a pool of `workers` threads, the chapters are yielded in order as soon as they and
+        every chapter before them are loaded. Consume the generator (e.g. with list()) to load all of them.
+        :param chapters: An iterable of chapters.
+        :param workers: The maximum number of chapters fetched at once, CHAPTER_FETCH_WORKERS by default.
+        :return: A generator of the loaded chapters.
+        """
+        if workers is None:
+            workers = CHAPTER_FETCH_WORKERS
+
+        chapters = iter(chapters)
+        if workers <= 1:
+            for chapter in chapters:
+                yield chapter.load()
+            return
+
+        # Keep at most `workers` chapters in flight, so a slow consumer doesn't buffer the whole story
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for chapter in chapters:
+                pending.append(pool.submit(metrics.bind(chapter.load)))
+                if len(pending) >= workers:
+                    break
+            try:
+                while pending:
+                    chapter = pending.popleft().result()
+                    following = next(chapters, None)
+                    if following is not None:
+                        pending.append(pool.submit(metrics.bind(following.load)))
+                    yield chapter
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    @property
+    def title(self):
+        if self._title is None:
+            self.load()
+        return self._title
+
+    @property
+    def story_text_id(self):
+        self.load()
+        return self._story_text_id
+
+    @property
+    def raw_text(self):
+        self.load()
+        return self._raw_text
+
+    @property
+    def text_list(self):
+        """List of the visible text nodes of the chapter, parsed from raw_text on first use."""
+        if self._text_list is None:
+            self._text_list = list(_visible_texts(lxml.html.fragment_fromstring(self.raw_text)))
+        return self._text_list
+
+    @property
+    def text(self):
+        return '\n'.join(self.text_list)
+
+    def get_reviews(self, workers=None, start_page=1):
         """
         A generator for all reviews for that chapter
+        :param workers: The maximum number of pages fetched at once, REVIEW_FETCH_WORKERS by default.
+        :param start_page: The page of reviews to start from.
         :return: A generator to fetch reviews.
         """
-        return ReviewsGenerator(self.story_id, self.number)
+        return ReviewsGenerator(self.story_id, self.number, workers=workers, start_page=start_page)
 
 
 class User(object):
@@ -474,8 +957,7 @@ class User(object):
     def download_data(self):
         self.timestamp = time()
         url = _USERID_URL_TEMPLATE % self.id
-        source = requests.get(url)
-        source = source.text
+        source = _fetch(url)
         self._soup = bs4.BeautifulSoup(source, 'html.parser')
         self.url = url
         self.username = _parse_string(_USERNAME_REGEX, source)
@@ -492,14 +974,14 @@ class User(object):
         except AttributeError:
             self.favourite_author_count = 0
         self._set_favourite_stories()
+        _parsed(self)
 
     def get_stories(self):
         """
         Get the stories written by this author.
         :return: A generator for stories by this author.
         """
-        xml_page_source = requests.get(root + '/atom/u/%d/' % self.id)
-        xml_page_source = xml_page_source.text
+        xml_page_source = _fetch(root + '/atom/u/%d/' % self.id)
         xml_soup = bs4.BeautifulSoup(xml_page_source, 'html.parser')
         entries = xml_soup.findAll('link', attrs={'rel': 'alternate'})
         for entry in entries:
@@ -555,8 +1037,7 @@ class FanFiction:
     def get_recommendations(fandom_title, medium="anime", character="", sort_by=FOLLOW, rating=ALL, download_num=0):
         url = root + "/%s/%s/?srt=%i&r=%i&c1=%s" % (medium, fandom_title, sort_by, rating, character)
         print(url)
-        r = requests.get(url)
-        source = r.text
+        source = _fetch(url)
         soup = bs4.BeautifulSoup(source, 'html.parser')
         story_list = soup.find_all("div", {"class": "z-list"})
 
@@ -595,8 +1076,7 @@ class FanFiction:
     @staticmethod
     def followed_fanfics():
         url = root + "/alert/story.php"
-        r = requests.get(url, headers=constants.headers)
-        source = r.text
+        source = _fetch(url)
         soup = bs4.BeautifulSoup(source, 'html.parser')
         tds = soup.find_all("td")
         for td in tds:
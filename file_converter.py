@@ -1,20 +1,384 @@
 from fanfiction_net_api import *
 from ebooklib import epub
+from epub_cache import epub_cache
+from metrics import metrics
 from os import path, remove
 import os
+import queue
+import threading
+from contextlib import contextmanager
+from time import time
 
 iBOOKS_PATH = "~/Downloads/"
 
+# Size of the pieces a streamed book is handed out in
+STREAM_CHUNK_SIZE = 64 * 1024
+# Seconds a streamed book waits for its reader to take a chunk before the build fails, e.g. when the client went away
+# before the response was started
+STREAM_STALL_TIMEOUT = float(os.environ.get('STREAM_STALL_TIMEOUT', 60))
+# Seconds a conversion waits for the same conversion running in another thread to finish
+CONVERSION_WAIT_TIMEOUT = float(os.environ.get('CONVERSION_WAIT_TIMEOUT', 30 * 60))
+# Seconds between two looks at a book file that is still being written, when there was nothing new to read
+_GROWING_FILE_POLL = 0.05
+# Number of threads rendering and compressing the chapters of a book, see EpubWriter option workers
+EPUB_WRITE_WORKERS = int(os.environ.get('EPUB_WRITE_WORKERS', os.cpu_count() or 1))
+
+
+class _EpubPipe(object):
+    """
+    Unseekable file object connecting the thread writing a book to the generator handing it out in chunks.
+    Writes block while the reader is STREAM_CHUNK_SIZE * 16 bytes behind and fail once the reader went away, or when
+    the reader took nothing for STREAM_STALL_TIMEOUT seconds.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=16)
+        self._buffer = bytearray()
+        self._reader_closed = False
+
+    def _put(self, item):
+        deadline = time() + STREAM_STALL_TIMEOUT
+        while True:
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if self._reader_closed:
+                    raise IOError('Reader of the book went away')
+                if time() > deadline:
+                    self.abort()
+                    raise IOError('Reader of the book took nothing for %d seconds' % STREAM_STALL_TIMEOUT)
+
+    def abort(self):
+        """Fails the writes of the book from now on, for a reader which won't read it."""
+        self._reader_closed = True
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= STREAM_CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            del self._buffer[:]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self, error=None):
+        """Hands out what is left, then ends the stream with error if it is given."""
+        if self._reader_closed:
+            return
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            del self._buffer[:]
+        self._put(error)
+
+    def chunks(self):
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            self._reader_closed = True
+
+
+class _GrowingFile(object):
+    """
+    Unseekable file object writing a book front to back, so the part written so far can be read while it grows.
+    Seekable files get their zip headers patched after the data, unseekable ones get data descriptors instead.
+    """
+
+    def __init__(self, f):
+        self._file = f
+
+    def write(self, data):
+        self._file.write(data)
+        # Readers have their own file object, they only see what reached the OS
+        self._file.flush()
+        return len(data)
+
+    def flush(self):
+        self._file.flush()
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=CONVERSION_WAIT_TIMEOUT):
+        if not self.done.wait(timeout):
+            raise TimeoutError('The conversion in flight did not finish within %d seconds' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight(object):
+    """
+    Deduplicates concurrent work: while a call for a key is in flight, other callers for the same key wait for it and
+    all get its result (or its exception) instead of doing the work again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def begin(self, key):
+        """
+        :return: Tuple (call, leader). Only the leader does the work and must pass its outcome to finish(),
+                 everybody else gets it from call.wait().
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def finish(self, key, call, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        call.result = result
+        call.error = error
+        call.done.set()
+
+    def do(self, key, function):
+        """Returns function(), which is run only once for all concurrent callers with the same key."""
+        call, leader = self.begin(key)
+        if not leader:
+            return call.wait()
+        try:
+            result = function()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result
+
+
+# Conversions in flight in this process, by story id
+conversions = SingleFlight()
+
+
+def _stage_timer(trace):
+    """
+    Returns the timer option of EpubWriter, timing its stages ('render' or 'compress') in metrics and in trace,
+    also when they run in the writer's threads.
+    """
+    @contextmanager
+    def timer(stage):
+        with metrics.using(trace), metrics.timer('fanfiction_%s_seconds' % stage):
+            yield
+    return timer
+
 
 class Converter:
 
-    def __init__(self, story_id):
+    def __init__(self, story_id, workers=None, cache=epub_cache, progress=None):
+        """
+        :param story_id: The story id of the story to convert.
+        :param workers: The number of chapters downloaded at once, see Story.get_chapters.
+        :param cache: The EpubCache converted books are kept in, or None to write them to the working directory.
+        :param progress: Function called as progress(chapters_done, chapter_count) after every written chapter.
+        """
         self.story_id = story_id
+        self.workers = workers
+        self.cache = cache
+        self.progress = progress
+        self.cache_key = None
         self.fanfic = Story(story_id)
 
-    def convert_to_epub(self):
+    def cached_epub(self):
+        """
+        Downloads the story metadata and looks the current version of the story up in the cache.
+        :return: The path of the cached epub file or None.
+        """
         self.fanfic.download_data()
-        self.fanfic.get_chapters()
+
+        if self.cache is None:
+            return None
+        self.cache_key = self.cache.key(self.fanfic)
+        return self.cache.get(self.cache_key)
+
+    def convert_to_epub(self, previous=None):
+        """
+        Converts the story, or reuses the cached book if the story didn't change since it was converted.
+        Concurrent calls for the same story share a single conversion.
+        :param previous: An earlier conversion of the story to update, by default the latest cached one.
+        :return: The path of the epub file.
+        """
+        def convert():
+            with metrics.timer('fanfiction_conversion_seconds'):
+                filename = self._convert_to_epub(previous)
+            return filename, self.fanfic, self.cache_key
+
+        filename, self.fanfic, self.cache_key = conversions.do(int(self.story_id), convert)
+        return filename
+
+    def _convert_to_epub(self, previous):
+        filename = self.cached_epub()
+        if filename is not None:
+            return filename
+
+        if self.cache is None:
+            # Absolute, the path is handed to send_file by the job downloads, which doesn't resolve it against the cwd
+            filename = path.abspath('%s.epub' % self.fanfic.title)
+            print("Saving to %s" % filename)
+            if path.exists(filename):
+                if previous is not None and path.samefile(previous, filename):
+                    # The old book is about to be replaced, keep it readable until the new one is written
+                    previous = filename + '.old'
+                    os.replace(filename, previous)
+                else:
+                    remove(filename)
+            self.write_epub(filename, previous)
+            if previous == filename + '.old':
+                remove(previous)
+            return filename
+
+        if previous is None:
+            previous = self._previous_version()
+        with self.cache.store(self.cache_key, self.fanfic.title) as filename:
+            print("Saving to %s" % filename)
+            self.write_epub(filename, previous)
+        return self.cache.get(self.cache_key)
+
+    def stream_epub(self, previous=None):
+        """
+        Converts the story in a background thread. Must be called after cached_epub.
+        With a cache, the book is written to the cache at the pace of the download and handed out from the file as it
+        grows, so a slow client doesn't hold up the other requests waiting for the same conversion.
+        :param previous: An earlier conversion of the story to update, by default the latest cached one.
+        :return: A generator yielding the epub file in chunks while it is being written.
+        """
+        if self.cache is None:
+            # Nothing to share the result through, every caller builds its own book
+            pipe = _EpubPipe()
+            threading.Thread(target=metrics.bind(self._stream_build), args=(pipe, previous), daemon=True).start()
+            return pipe.chunks()
+
+        key = int(self.story_id)
+        call, leader = conversions.begin(key)
+        if not leader:
+            return self._stream_result(call)
+
+        try:
+            if previous is None:
+                previous = self._previous_version()
+            # The build writes to the cache at its own pace, the response only reads what is written so far
+            opened = queue.Queue(maxsize=1)
+            threading.Thread(target=metrics.bind(self._cache_build), args=(key, call, previous, opened),
+                             daemon=True).start()
+        except BaseException as e:
+            conversions.finish(key, call, error=e)
+            raise
+        return self._stream_growing(call, opened)
+
+    def _cache_build(self, key, call, previous, opened):
+        """Writes the book to the cache and finishes the conversion, opened gets a reader of the file or None."""
+        reader = None
+        try:
+            with self.cache.store(self.cache_key, self.fanfic.title) as filename:
+                with open(filename, 'wb') as f:
+                    # Opened before the file is written, it stays readable when store moves or removes it
+                    reader = open(filename, 'rb')
+                    opened.put(reader)
+                    self.write_epub(_GrowingFile(f), previous)
+        except BaseException as e:
+            conversions.finish(key, call, error=e)
+        else:
+            conversions.finish(key, call, (self.cache.get(self.cache_key), self.fanfic, self.cache_key))
+        finally:
+            if reader is None:
+                opened.put(None)
+
+    @staticmethod
+    def _stream_growing(call, opened):
+        """Yields the book being written by _cache_build, following the file until the build is finished."""
+        reader = opened.get()
+        if reader is None:
+            # The build failed before writing anything
+            call.wait()
+            return
+        with reader:
+            while True:
+                finished = call.done.is_set()
+                chunk = reader.read(STREAM_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                elif finished:
+                    # Raises the error of a build that failed after the reader saw part of the book
+                    call.wait()
+                    return
+                else:
+                    call.done.wait(_GROWING_FILE_POLL)
+
+    def _stream_build(self, pipe, previous):
+        try:
+            self.write_epub(pipe, previous)
+        except BaseException as e:
+            pipe.close(e)
+            raise
+        pipe.close()
+
+    @staticmethod
+    def _stream_result(call):
+        """Yields the book built by another in-flight conversion of the story once it is finished."""
+        filename = call.wait()[0]
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _previous_version(self):
+        """
+        :return: The path of the newest cached book of the story with fewer chapters than it has now, or None.
+        """
+        for key in self.cache.versions(self.story_id):
+            if key[2] < self.fanfic.chapter_count:
+                filename = self.cache.get(key)
+                if filename is not None:
+                    return filename
+        return None
+
+    def _previous_chapters(self, previous):
+        """
+        Reads the table of contents of an earlier conversion of the story.
+        :return: List of (file name, title) of its chapters, or an empty list if it can't be updated.
+        """
+        try:
+            # Only the table of contents is needed, chapters stay compressed in the file
+            old_book = epub.read_epub(previous, {'lazy': True})
+        except (IOError, epub.EpubException) as e:
+            print("Can't read %s: %s" % (previous, e))
+            return []
+        with old_book:
+            if old_book.uid != str(self.story_id):
+                return []
+
+            for entry in old_book.toc:
+                if isinstance(entry, tuple) and entry[0].title == 'Chapters':
+                    old_chapters = [(link.href, link.title) for link in entry[1]]
+                    # Chapters may have been removed or reordered, only append to books we can trust
+                    if len(old_chapters) <= self.fanfic.chapter_count and \
+                            all(href == 'chapter_%d.xhtml' % i for i, (href, _) in enumerate(old_chapters)):
+                        return old_chapters
+        return []
+
+    def write_epub(self, filename, previous=None):
+        """
+        Downloads the chapters of the story and writes the book to filename, which may also be a file object.
+        :param previous: An earlier conversion of the story. Its chapters are copied into the new book as they are,
+                         only the chapters added since are downloaded.
+        """
+        old_chapters = self._previous_chapters(previous) if previous is not None else []
 
         book = epub.EpubBook()
 
@@ -26,6 +390,14 @@ class Converter:
 
         book.add_author(self.fanfic.author_id)
 
+        # Chapters are written to the file as soon as they are downloaded, see EpubStreamWriter
+        options = {'timer': _stage_timer(metrics.current_trace()), 'workers': EPUB_WRITE_WORKERS}
+        if old_chapters:
+            options['copy_from'] = previous
+            options['copy_items'] = set(file_name for file_name, _ in old_chapters)
+        writer = epub.EpubStreamWriter(filename, book, options)
+        writer.open()
+
         intro_ch = epub.EpubHtml(title="Introduction", file_name='intro.xhtml')
         # intro_ch.add_item(doc_style)
         intro_ch.content = """
@@ -42,18 +414,32 @@ class Converter:
                 </body>
                 </html>
                 """ % (self.fanfic.title, self.fanfic.author_id, ",".join(self.fanfic.fandoms), self.fanfic.genre)
-        book.add_item(intro_ch)
+        writer.write_item(intro_ch)
 
         chapters = []
-        for i, chapter in enumerate(self.fanfic.chapters):
+        for file_name, title in old_chapters:
+            c1 = epub.EpubHtml(title=title, file_name=file_name, lang='en')
+            writer.write_item(c1)
+            chapters.append(c1)
+        if old_chapters:
+            print("Reusing %d chapters of %s" % (len(old_chapters), previous))
+            metrics.inc('fanfiction_chapters_total', len(old_chapters), source='reused')
+            if self.progress is not None:
+                self.progress(len(old_chapters), self.fanfic.chapter_count)
+
+        new_chapters = self.fanfic.get_chapters(workers=self.workers, first=len(old_chapters) + 1)
+        for i, chapter in enumerate(new_chapters, len(old_chapters)):
             # create chapter
             c1 = epub.EpubHtml(title=chapter.title, file_name='chapter_%s.xhtml' % i, lang='en')
             c1.content = chapter.raw_text
 
             # add chapter
-            book.add_item(c1)
+            writer.write_item(c1)
+            metrics.inc('fanfiction_chapters_total', source='downloaded')
 
             chapters.append(c1)
+            if self.progress is not None:
+                self.progress(i + 1, self.fanfic.chapter_count)
 
         # define Table Of Contents
         book.toc = (
@@ -78,14 +464,9 @@ class Converter:
         book.add_item(nav_page)
         book.spine = [intro_ch, nav_page] + chapters
 
-        # write to the file
+        # write the rest of the file
         # filename = os.path.expanduser(iBOOKS_PATH) + '%s.epub' % self.fanfic.title # This doesn't work on heroku
-        filename = '%s.epub' % self.fanfic.title
-        print("Saving to %s" % filename)
-        if path.exists(filename):
-            remove(filename)
-        epub.write_epub(filename, book, {})
-        return filename
+        writer.close()
 
 if __name__ == "__main__":
     convert = Converter(6121795)
@@ -0,0 +1,194 @@
+import json
+import os
+import sqlite3
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep
+
+from file_converter import Converter
+from metrics import metrics, write_trace
+
+# SQLite database holding the jobs, shared by every server process
+JOBS_DB = os.environ.get('JOBS_DB', os.path.join('cache', 'jobs.sqlite'))
+# Number of conversions a server process runs at once
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Seconds without progress after which a queued or running job is considered dead (its process was restarted)
+JOB_STALE_AFTER = float(os.environ.get('JOB_STALE_AFTER', 10 * 60))
+# Seconds between two refreshes of the updated time of the jobs a process holds, well within JOB_STALE_AFTER
+_HEARTBEAT_INTERVAL = JOB_STALE_AFTER / 4
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    story_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    chapters_done INTEGER NOT NULL DEFAULT 0,
+    chapter_count INTEGER,
+    title TEXT,
+    path TEXT,
+    error TEXT,
+    trace TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_story_status ON jobs (story_id, status);
+"""
+
+_COLUMNS = ['id', 'story_id', 'status', 'chapters_done', 'chapter_count', 'title', 'path', 'error', 'trace',
+            'created', 'updated']
+
+
+class JobQueue(object):
+    """
+    Converts stories in background threads.
+
+    Jobs are kept in a SQLite database so their state can be queried from any server process. A story with a live
+    queued or running job doesn't get a second one, the existing job id is returned instead.
+
+    Queued and running jobs only live in the threads of the process that accepted them. While it holds them, the
+    process refreshes their updated time every _HEARTBEAT_INTERVAL seconds, also while they wait in the pool or for a
+    conversion of the same story in flight. A job that wasn't updated for JOB_STALE_AFTER seconds belonged to a
+    process that is gone, it is reported as failed.
+
+    Attributes:
+        db_path (str):  Path of the SQLite database
+        workers (int):  Number of conversions run at once by this process
+    """
+
+    def __init__(self, db_path=JOBS_DB, workers=JOB_WORKERS, converter=Converter):
+        self.db_path = db_path
+        self.workers = workers
+        self.converter = converter
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        # Ids of the queued and running jobs of this process
+        self._held = set()
+        self._held_lock = threading.Lock()
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._db()
+        db.executescript(_SCHEMA)
+        # Databases created before jobs were traced lack the column
+        if 'trace' not in [row[1] for row in db.execute('PRAGMA table_info(jobs)')]:
+            db.execute('ALTER TABLE jobs ADD COLUMN trace TEXT')
+
+        heartbeat = threading.Thread(target=self._heartbeat, name='job-heartbeat')
+        heartbeat.daemon = True
+        heartbeat.start()
+
+    def _db(self):
+        """Returns the connection of the current thread, sqlite3 connections can't be shared between threads."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.db = db
+        return db
+
+    def _update(self, job_id, **fields):
+        fields['updated'] = time()
+        assignments = ', '.join('%s = ?' % name for name in fields)
+        self._db().execute('UPDATE jobs SET %s WHERE id = ?' % assignments, list(fields.values()) + [job_id])
+
+    def submit(self, story_id):
+        """
+        Queues the conversion of a story, unless it is already queued or running.
+        :param story_id: The story id of the story to convert.
+        :return: The job id.
+        """
+        story_id = int(story_id)
+        now = time()
+        db = self._db()
+        # IMMEDIATE takes the write lock up front, so two processes can't both miss the existing job
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT id FROM jobs WHERE story_id = ? AND status IN (?, ?) AND updated > ? '
+                             'ORDER BY created DESC LIMIT 1',
+                             (story_id, QUEUED, RUNNING, now - JOB_STALE_AFTER)).fetchone()
+            if row is not None:
+                db.execute('COMMIT')
+                return row[0]
+
+            job_id = uuid.uuid4().hex
+            db.execute('INSERT INTO jobs (id, story_id, status, created, updated) VALUES (?, ?, ?, ?, ?)',
+                       (job_id, story_id, QUEUED, now, now))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+        with self._held_lock:
+            self._held.add(job_id)
+        self._pool.submit(self._run, job_id, story_id)
+        return job_id
+
+    def get(self, job_id):
+        """
+        :return: The job as a dict with the columns of the jobs table, or None if there is no such job.
+        """
+        db = self._db()
+        # A live job nobody updated for JOB_STALE_AFTER seconds was lost with its process, it will never finish
+        db.execute('UPDATE jobs SET status = ?, error = ? WHERE id = ? AND status IN (?, ?) AND updated <= ?',
+                   (FAILED, 'Interrupted, the server process running the job stopped', job_id, QUEUED, RUNNING,
+                    time() - JOB_STALE_AFTER))
+        row = db.execute('SELECT %s FROM jobs WHERE id = ?' % ', '.join(_COLUMNS), (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        if job['trace'] is not None:
+            job['trace'] = json.loads(job['trace'])
+        return job
+
+    def _heartbeat(self):
+        while True:
+            sleep(_HEARTBEAT_INTERVAL)
+            with self._held_lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                self._db().execute('UPDATE jobs SET updated = ? WHERE id IN (%s) AND status IN (?, ?)'
+                                   % ', '.join('?' * len(held)), [time()] + held + [QUEUED, RUNNING])
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    def _run(self, job_id, story_id):
+        try:
+            self._convert(job_id, story_id)
+        finally:
+            with self._held_lock:
+                self._held.discard(job_id)
+
+    def _convert(self, job_id, story_id):
+        self._update(job_id, status=RUNNING)
+
+        def progress(chapters_done, chapter_count):
+            self._update(job_id, chapters_done=chapters_done, chapter_count=chapter_count)
+
+        with metrics.trace(job_id=job_id, story_id=story_id) as trace:
+            try:
+                convert = self.converter(story_id, progress=progress)
+                path = convert.convert_to_epub()
+            except Exception as e:
+                traceback.print_exc()
+                error = '%s: %s' % (type(e).__name__, e)
+            else:
+                error = None
+
+        record = trace.record()
+        record['status'] = FAILED if error else DONE
+        write_trace(record)
+        if error:
+            self._update(job_id, status=FAILED, error=error, trace=json.dumps(record))
+        else:
+            self._update(job_id, status=DONE, path=path, title=convert.fanfic.title, trace=json.dumps(record),
+                         chapters_done=convert.fanfic.chapter_count, chapter_count=convert.fanfic.chapter_count)
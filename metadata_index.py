@@ -0,0 +1,382 @@
+import os
+import sqlite3
+import threading
+import traceback
+from time import time
+
+import file_converter  # imported first, it sets up fanfiction_net_api
+import fanfiction_net_api
+from fanfiction_net_api import User, fetch_story_metadata
+
+# SQLite database holding the metadata of every story and user seen, shared by every server process
+METADATA_INDEX_DB = os.environ.get('METADATA_INDEX_DB', os.path.join('cache', 'metadata.sqlite'))
+# Seconds after which the metadata of a story is fetched again by a refresh
+METADATA_MAX_AGE = float(os.environ.get('METADATA_MAX_AGE', 24 * 60 * 60))
+# Number of stories fetched by one refresh
+METADATA_REFRESH_BATCH = int(os.environ.get('METADATA_REFRESH_BATCH', 200))
+# Seconds a background refresh waits when no story is due, 0 disables the background refresh
+METADATA_REFRESH_INTERVAL = float(os.environ.get('METADATA_REFRESH_INTERVAL', 10 * 60))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    author_id INTEGER,
+    rated TEXT,
+    language TEXT,
+    chapter_count INTEGER,
+    word_count INTEGER,
+    reviews INTEGER,
+    favs INTEGER,
+    followers INTEGER,
+    date_published REAL,
+    date_updated REAL,
+    complete INTEGER,
+    error TEXT,
+    indexed REAL,
+    checked REAL NOT NULL,
+    tracked INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS stories_word_count ON stories (word_count);
+CREATE INDEX IF NOT EXISTS stories_date_updated ON stories (date_updated);
+CREATE INDEX IF NOT EXISTS stories_followers ON stories (followers);
+CREATE INDEX IF NOT EXISTS stories_author ON stories (author_id);
+CREATE INDEX IF NOT EXISTS stories_tracked ON stories (tracked, checked);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    story_count INTEGER,
+    favourite_count INTEGER,
+    favourite_author_count INTEGER,
+    indexed REAL
+);
+
+CREATE TABLE IF NOT EXISTS fandoms (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS characters (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS genres (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+
+CREATE TABLE IF NOT EXISTS story_fandoms (
+    story_id INTEGER NOT NULL,
+    fandom_id INTEGER NOT NULL,
+    PRIMARY KEY (story_id, fandom_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS story_characters (
+    story_id INTEGER NOT NULL,
+    character_id INTEGER NOT NULL,
+    PRIMARY KEY (story_id, character_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS story_genres (
+    story_id INTEGER NOT NULL,
+    genre_id INTEGER NOT NULL,
+    PRIMARY KEY (story_id, genre_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS story_fandoms_fandom ON story_fandoms (fandom_id, story_id);
+CREATE INDEX IF NOT EXISTS story_characters_character ON story_characters (character_id, story_id);
+CREATE INDEX IF NOT EXISTS story_genres_genre ON story_genres (genre_id, story_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS stories_fts USING fts5(title, fandoms, characters);
+"""
+
+# Columns written by add_story
+_INDEXED_COLUMNS = ['id', 'title', 'author_id', 'rated', 'language', 'chapter_count', 'word_count', 'reviews', 'favs',
+                    'followers', 'date_published', 'date_updated', 'complete', 'error', 'indexed', 'checked']
+_STORY_COLUMNS = _INDEXED_COLUMNS + ['tracked']
+_USER_COLUMNS = ['id', 'username', 'story_count', 'favourite_count', 'favourite_author_count', 'indexed']
+
+# Names of the lists of a story: attribute of Story, lookup table, its column in the link table
+_LISTS = [('fandoms', 'fandoms', 'fandom_id'), ('characters', 'characters', 'character_id'),
+          ('genre', 'genres', 'genre_id')]
+
+# Columns listings can be ordered by, newest or largest first
+ORDERS = ('date_updated', 'date_published', 'followers', 'favs', 'reviews', 'word_count')
+
+# Separates the names of a list in the query results, can't appear in a name
+_SEPARATOR = '\x1f'
+
+# Every list of a story as a column of names
+_LIST_COLUMNS = ', '.join(
+    "(SELECT group_concat(l.name, char(31)) FROM story_%s sl JOIN %s l ON l.id = sl.%s WHERE sl.story_id = s.id) "
+    "AS %s" % (table, table, column, attribute) for attribute, table, column in _LISTS)
+
+
+def _timestamp(value):
+    return None if value is None else value.timestamp()
+
+
+def _fts_query(text):
+    """Turns the words of a search into an FTS5 query matching all of them, without its operators."""
+    return ' '.join('"%s"' % word.replace('"', '""') for word in text.split())
+
+
+class MetadataIndex(object):
+    """
+    Local index of the metadata of stories and users, answering lookups and filtered listings without a request.
+
+    Stories are indexed by fandom, character, genre, word count, update date and followers, and their title, fandoms
+    and characters are searchable through SQLite FTS5. The index is filled by attach, which adds every story and user
+    the library parses. Stories passed to track are kept current by refresh, which fetches the ones whose metadata is
+    older than max_age. Stories only seen in passing, e.g. in the favourites of a user, are never fetched by it.
+
+    >>> index = MetadataIndex()
+    >>> index.attach()
+    >>> index.track([story_id])
+    >>> index.refresh()
+    >>> index.stories(fandom='Naruto', min_words=100000, order_by='followers')
+
+    Attributes:
+        db_path (str):      Path of the SQLite database
+        max_age (float):    Seconds after which the metadata of a story is fetched again
+        workers (int):      Number of stories fetched at once by a refresh, METADATA_FETCH_WORKERS by default
+    """
+
+    def __init__(self, db_path=METADATA_INDEX_DB, max_age=METADATA_MAX_AGE, workers=None):
+        self.db_path = db_path
+        self.max_age = max_age
+        self.workers = workers
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._db()
+        # Readers don't wait for the background refresh
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(_SCHEMA)
+
+    def _db(self):
+        """Returns the connection of the current thread, sqlite3 connections can't be shared between threads."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.db = db
+        return db
+
+    def attach(self):
+        """Adds every story and user parsed by fanfiction_net_api from now on to the index."""
+        if self.add not in fanfiction_net_api.parsed_hooks:
+            fanfiction_net_api.parsed_hooks.append(self.add)
+
+    def detach(self):
+        """Stops adding the parsed stories and users."""
+        if self.add in fanfiction_net_api.parsed_hooks:
+            fanfiction_net_api.parsed_hooks.remove(self.add)
+
+    def add(self, item):
+        """
+        Adds or updates a story or user, the parsed_hooks entry point. An index that can't be written doesn't fail the
+        download that parsed the item, the error is printed.
+        :param item: A Story or StoryMetadata, or a User.
+        """
+        try:
+            if isinstance(item, User):
+                self.add_user(item)
+            else:
+                self.add_story(item)
+        except sqlite3.Error:
+            traceback.print_exc()
+
+    def add_story(self, story):
+        """
+        Adds or updates a story.
+        :param story: A downloaded Story, or a StoryMetadata record. Records of a failed fetch only keep their error,
+                      the metadata indexed before is kept.
+        """
+        now = time()
+        story_id = int(story.id)
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if getattr(story, 'error', None) is not None:
+                db.execute('INSERT INTO stories (id, error, checked) VALUES (?, ?, ?) '
+                           'ON CONFLICT (id) DO UPDATE SET error = excluded.error, checked = excluded.checked',
+                           (story_id, story.error, now))
+                db.execute('COMMIT')
+                return
+
+            values = [story_id, story.title, story.author_id, story.rated, story.language, story.chapter_count,
+                      story.word_count, story.reviews, story.favs, story.followers,
+                      _timestamp(story.date_published), _timestamp(story.date_updated), int(story.complete), None,
+                      now, now]
+            # An update keeps whether the story is tracked
+            db.execute('INSERT INTO stories (%s) VALUES (%s) ON CONFLICT (id) DO UPDATE SET %s'
+                       % (', '.join(_INDEXED_COLUMNS), ', '.join('?' * len(_INDEXED_COLUMNS)),
+                          ', '.join('%s = excluded.%s' % (column, column) for column in _INDEXED_COLUMNS[1:])),
+                       values)
+            if story.author_id is not None:
+                db.execute('INSERT OR IGNORE INTO users (id) VALUES (?)', (story.author_id,))
+
+            for attribute, table, column in _LISTS:
+                db.execute('DELETE FROM story_%s WHERE story_id = ?' % table, (story_id,))
+                for name in getattr(story, attribute) or []:
+                    db.execute('INSERT OR IGNORE INTO %s (name) VALUES (?)' % table, (name,))
+                    db.execute('INSERT OR IGNORE INTO story_%s (story_id, %s) SELECT ?, id FROM %s WHERE name = ?'
+                               % (table, column, table), (story_id, name))
+
+            db.execute('DELETE FROM stories_fts WHERE rowid = ?', (story_id,))
+            db.execute('INSERT INTO stories_fts (rowid, title, fandoms, characters) VALUES (?, ?, ?, ?)',
+                       (story_id, story.title, ' '.join(story.fandoms or []), ' '.join(story.characters or [])))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def add_user(self, user):
+        """Adds or updates a downloaded User, the stories in its favourites are added by the parsed_hooks."""
+        self._db().execute('INSERT OR REPLACE INTO users (%s) VALUES (%s)'
+                           % (', '.join(_USER_COLUMNS), ', '.join('?' * len(_USER_COLUMNS))),
+                           (int(user.id), user.username, user.story_count, user.favourite_count,
+                            user.favourite_author_count, time()))
+
+    def track(self, story_ids):
+        """
+        Keeps stories current, refresh fetches them whenever their metadata is older than max_age. Stories which
+        aren't indexed yet are fetched by the next refresh.
+        :param story_ids: An iterable of story ids.
+        """
+        self._db().executemany('INSERT INTO stories (id, checked, tracked) VALUES (?, 0, 1) '
+                               'ON CONFLICT (id) DO UPDATE SET tracked = 1',
+                               [(int(story_id),) for story_id in story_ids])
+
+    def untrack(self, story_ids):
+        """Stops refreshing stories, their metadata stays in the index."""
+        self._db().executemany('UPDATE stories SET tracked = 0 WHERE id = ?',
+                               [(int(story_id),) for story_id in story_ids])
+
+    def story(self, story_id):
+        """
+        :return: The story as a dict with the columns of the stories table and its fandoms, characters and genre as
+                 lists, dates as Unix timestamps, or None if it isn't indexed yet.
+        """
+        rows = self._query('WHERE s.id = ? AND s.title IS NOT NULL', [int(story_id)])
+        return rows[0] if rows else None
+
+    def user(self, user_id):
+        """
+        :return: The user as a dict with the columns of the users table and the ids of the indexed stories they
+                 wrote, or None if the user is unknown.
+        """
+        db = self._db()
+        row = db.execute('SELECT %s FROM users WHERE id = ?' % ', '.join(_USER_COLUMNS), (int(user_id),)).fetchone()
+        if row is None:
+            return None
+        user = dict(zip(_USER_COLUMNS, row))
+        user['stories'] = [story_id for (story_id,) in db.execute(
+            'SELECT id FROM stories WHERE author_id = ? AND title IS NOT NULL ORDER BY id', (int(user_id),))]
+        return user
+
+    def stories(self, fandom=None, character=None, genre=None, text=None, min_words=None, max_words=None,
+                updated_since=None, min_follows=None, complete=None, rated=None, language=None,
+                order_by='date_updated', limit=50, offset=0):
+        """
+        Lists indexed stories matching every given filter.
+        :param fandom: Name of a fandom of the stories.
+        :param character: Name of a character of the stories.
+        :param genre: Name of a genre of the stories.
+        :param text: Words which all appear in the title, fandoms or characters.
+        :param min_words: The minimum word count.
+        :param max_words: The maximum word count.
+        :param updated_since: A datetime or Unix timestamp, the stories updated at or after it.
+        :param min_follows: The minimum number of followers.
+        :param complete: True or False to list only complete or incomplete stories.
+        :param rated: The rating, e.g. 'T'.
+        :param language: The language, e.g. 'English'.
+        :param order_by: One of ORDERS, stories are listed largest or newest first.
+        :param limit: The maximum number of stories returned.
+        :param offset: The number of matching stories skipped.
+        :return: List of stories as returned by story.
+        """
+        if order_by not in ORDERS:
+            raise ValueError('Unknown order %s, expected one of %s' % (order_by, ', '.join(ORDERS)))
+        conditions = ['s.title IS NOT NULL']
+        parameters = []
+        for name, (attribute, table, column) in zip((fandom, character, genre), _LISTS):
+            if name is not None:
+                conditions.append('s.id IN (SELECT sl.story_id FROM story_%s sl JOIN %s l ON l.id = sl.%s '
+                                  'WHERE l.name = ?)' % (table, table, column))
+                parameters.append(name)
+        if text:
+            conditions.append('s.id IN (SELECT rowid FROM stories_fts WHERE stories_fts MATCH ?)')
+            parameters.append(_fts_query(text))
+        if updated_since is not None and not isinstance(updated_since, (int, float)):
+            updated_since = updated_since.timestamp()
+        for value, condition in ((min_words, 's.word_count >= ?'), (max_words, 's.word_count <= ?'),
+                                 (updated_since, 's.date_updated >= ?'), (min_follows, 's.followers >= ?'),
+                                 (rated, 's.rated = ?'), (language, 's.language = ?'),
+                                 (None if complete is None else int(complete), 's.complete = ?')):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        return self._query('WHERE %s ORDER BY s.%s DESC, s.id DESC LIMIT ? OFFSET ?'
+                           % (' AND '.join(conditions), order_by), parameters + [int(limit), int(offset)])
+
+    def _query(self, where, parameters):
+        rows = self._db().execute('SELECT %s, %s FROM stories s %s'
+                                  % (', '.join('s.' + column for column in _STORY_COLUMNS), _LIST_COLUMNS, where),
+                                  parameters)
+        stories = []
+        for row in rows:
+            story = dict(zip(_STORY_COLUMNS, row))
+            for (attribute, _, _), names in zip(_LISTS, row[len(_STORY_COLUMNS):]):
+                story[attribute] = names.split(_SEPARATOR) if names else []
+            story['complete'] = bool(story['complete'])
+            story['tracked'] = bool(story['tracked'])
+            stories.append(story)
+        return stories
+
+    def refresh(self, limit=METADATA_REFRESH_BATCH):
+        """
+        Fetches the tracked stories which were never fetched or not within max_age, least recently checked first. The
+        stories are claimed before they are fetched, so refreshes running in other processes pick different ones.
+        :param limit: The maximum number of stories fetched.
+        :return: Number of stories fetched, including the ones which failed.
+        """
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            story_ids = [story_id for (story_id,) in db.execute(
+                'SELECT id FROM stories WHERE tracked = 1 AND checked < ? ORDER BY checked LIMIT ?',
+                (time() - self.max_age, int(limit)))]
+            db.executemany('UPDATE stories SET checked = ? WHERE id = ?',
+                           [(time(), story_id) for story_id in story_ids])
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+        for record in fetch_story_metadata(story_ids, workers=self.workers):
+            self.add_story(record)
+        return len(story_ids)
+
+    def start(self, interval=METADATA_REFRESH_INTERVAL):
+        """
+        Refreshes the index in a background thread until stop is called. Batches follow each other while stories are
+        due, then the thread waits interval seconds before looking again.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh_forever, args=(interval,), name='metadata-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background refresh after its current batch."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh_forever(self, interval):
+        while not self._stop.is_set():
+            try:
+                fetched = self.refresh()
+            except Exception:
+                # Keep the thread alive, e.g. through a locked database or an outage of the site
+                traceback.print_exc()
+                fetched = 0
+            if not fetched:
+                self._stop.wait(interval)
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+
+# File every conversion job appends its trace record to as a JSON line, an empty value disables it
+TRACE_LOG = os.environ.get('TRACE_LOG', os.path.join('cache', 'traces.jsonl'))
+# Size in bytes above which the trace log is moved to <TRACE_LOG>.1, replacing the previous one, and started afresh
+TRACE_LOG_MAX_BYTES = int(os.environ.get('TRACE_LOG_MAX_BYTES', 16 * 1024 * 1024))
+
+# Help text of the metrics, in the order they are exposed
+_HELP = [
+    ('fanfiction_fetch_requests_total', 'counter', 'Pages requested, by where they came from'),
+    ('fanfiction_fetch_bytes_total', 'counter', 'Bytes of pages downloaded from the site'),
+    ('fanfiction_fetch_retries_total', 'counter', 'Requests retried after the site pushed back or failed'),
+    ('fanfiction_fetch_seconds', 'summary', 'Time spent downloading pages from the site'),
+    ('fanfiction_parse_seconds', 'summary', 'Time spent parsing pages, by kind of page'),
+    ('fanfiction_render_seconds', 'summary', 'Time spent serializing epub items'),
+    ('fanfiction_compress_seconds', 'summary', 'Time spent compressing epub items into the zip'),
+    ('fanfiction_chapters_total', 'counter', 'Chapters written to books, downloaded or reused from an older book'),
+    ('fanfiction_conversion_seconds', 'summary', 'Time spent converting stories'),
+]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+class Trace(object):
+    """
+    Timers and counters of a single conversion, with the same names as the process wide ones (without labels).
+
+    Attributes:
+        fields  (dict): Identification of the traced work, e.g. job and story id
+        started (float): Timestamp of the start
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self.started = time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+
+    def _inc(self, name, value):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def _observe(self, name, seconds):
+        with self._lock:
+            count, total = self._timers.get(name, (0, 0.0))
+            self._timers[name] = (count + 1, total + seconds)
+
+    def record(self):
+        """Returns the trace as a JSON serializable dict."""
+        with self._lock:
+            record = dict(self.fields)
+            record['started'] = self.started
+            record['seconds'] = time() - self.started
+            record['counters'] = dict(self._counters)
+            record['timers'] = {name: {'count': count, 'seconds': total}
+                                for name, (count, total) in self._timers.items()}
+        return record
+
+
+class Metrics(object):
+    """
+    Counters and timers of this process, exposed in the Prometheus text format.
+
+    Every value is also added to the trace of the current thread, see trace() and bind().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._local = threading.local()
+
+    def current_trace(self):
+        """Returns the trace collecting the work of the current thread or None."""
+        return getattr(self._local, 'trace', None)
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to a counter."""
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        trace = self.current_trace()
+        if trace is not None:
+            trace._inc(name, value)
+
+    def observe(self, name, seconds, **labels):
+        """Adds a duration to a timer."""
+        key = (name, _labels(labels))
+        with self._lock:
+            count, total = self._timers.get(key, (0, 0.0))
+            self._timers[key] = (count + 1, total + seconds)
+        trace = self.current_trace()
+        if trace is not None:
+            trace._observe(name, seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager adding the time spent in its block to a timer."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    @contextmanager
+    def trace(self, **fields):
+        """
+        Context manager collecting what the current thread does in its block into a new Trace.
+
+        >>> with metrics.trace(job_id=job_id) as trace:
+        ...     convert.convert_to_epub()
+        >>> trace.record()
+        """
+        with self.using(Trace(**fields)) as trace:
+            yield trace
+
+    @contextmanager
+    def using(self, trace):
+        """Context manager collecting what the current thread does in its block into an existing trace."""
+        previous = self.current_trace()
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+
+    def bind(self, function):
+        """Returns function running under the trace of the current thread, for handing work to other threads."""
+        trace = self.current_trace()
+        if trace is None:
+            return function
+
+        def bound(*args, **kwargs):
+            with self.using(trace):
+                return function(*args, **kwargs)
+        return bound
+
+    def render(self, gauges=None, counters=None):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        :param gauges: Dict of additional gauge names and their current values.
+        :param counters: Dict of additional counter names and their current values, names end with _total.
+        """
+        with self._lock:
+            counter_values = dict(self._counters)
+            timers = dict(self._timers)
+
+        lines = []
+        for name, kind, help in _HELP:
+            if kind == 'counter':
+                samples = [(labels, value) for (key, labels), value in counter_values.items() if key == name]
+            else:
+                samples = [(labels, value) for (key, labels), value in timers.items() if key == name]
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(samples):
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, _format_labels(labels), value))
+                else:
+                    count, total = value
+                    lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+                    lines.append('%s_sum%s %f' % (name, _format_labels(labels), total))
+        for name, value in sorted((gauges or {}).items()):
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, value))
+        for name, value in sorted((counters or {}).items()):
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+_trace_log_lock = threading.Lock()
+
+
+def write_trace(record, path=TRACE_LOG, max_bytes=TRACE_LOG_MAX_BYTES):
+    """
+    Appends a trace record to the trace log as a JSON line. The log is rotated once it is larger than max_bytes, so it
+    takes at most about twice that on disk.
+    """
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with _trace_log_lock:
+        with open(path, 'a') as f:
+            f.write(line)
+            size = f.tell()
+        if size > max_bytes:
+            os.replace(path, path + '.1')
+
+
+metrics = Metrics()
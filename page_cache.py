@@ -0,0 +1,129 @@
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+from time import time
+
+# Directory of the cache, an empty value disables caching
+PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR', os.path.join('cache', 'pages'))
+# Seconds a page is considered fresh when it can't be revalidated against an update date
+PAGE_CACHE_TTL = float(os.environ.get('PAGE_CACHE_TTL', 60 * 60))
+# Maximum size of the cache on disk in bytes, least recently used pages are removed above it
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+
+class PageCache(object):
+    """
+    Persistent cache of downloaded pages.
+
+    Every page is stored zlib-compressed in a file named after the SHA-1 of its url. The modification time of a file
+    is the moment the page was downloaded and its access time the moment it was last read, which is what the LRU
+    eviction orders by.
+
+    Attributes:
+        directory   (str):  Directory holding the cached pages
+        ttl         (float): Seconds a page stays fresh when no update date is known
+        max_bytes   (int):  Size above which least recently used pages are removed
+    """
+
+    def __init__(self, directory, ttl=PAGE_CACHE_TTL, max_bytes=PAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    pass
+
+    def get(self, url, valid_since=None):
+        """
+        Returns the cached source of url or None if there is no fresh copy.
+        :param url: The url of the page.
+        :param valid_since: Timestamp of the last change of the page if it is known. A copy downloaded after it is
+                            fresh whatever its age, otherwise the page is fresh for `ttl` seconds.
+        :return: The page source or None.
+        """
+        path = self._path(url)
+        try:
+            stat = os.stat(path)
+            if valid_since is not None:
+                if stat.st_mtime < valid_since:
+                    return None
+            elif time() - stat.st_mtime > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                source = zlib.decompress(f.read()).decode('utf-8')
+            # Keep the download time, but mark the page as recently used
+            os.utime(path, (time(), stat.st_mtime))
+        except (OSError, zlib.error):
+            return None
+        return source
+
+    def put(self, url, source):
+        """
+        Stores source as the current copy of url.
+        :param url: The url of the page.
+        :param source: The page source.
+        """
+        path = self._path(url)
+        data = zlib.compress(source.encode('utf-8'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique across the threads and the processes writing the same page
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            try:
+                old_size = os.stat(path).st_size
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(stat.st_size for _, stat in self._entries())
+            else:
+                self._size += len(data) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Removes least recently used pages until the cache takes less than 90% of max_bytes."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_atime)
+        self._size = sum(stat.st_size for _, stat in entries)
+        for path, stat in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= stat.st_size
+
+    def clear(self):
+        """Removes every cached page."""
+        with self._lock:
+            for path, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
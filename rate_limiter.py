@@ -0,0 +1,96 @@
+import os
+import random
+import threading
+from time import monotonic, sleep
+
+# Highest number of requests per second sent upstream
+UPSTREAM_RATE = float(os.environ.get('UPSTREAM_RATE', 5))
+# Number of requests which may be sent at once after a quiet period
+UPSTREAM_BURST = int(os.environ.get('UPSTREAM_BURST', 5))
+# The rate never drops below this, however often the site pushes back
+UPSTREAM_MIN_RATE = float(os.environ.get('UPSTREAM_MIN_RATE', 0.2))
+
+
+class RateLimiter(object):
+    """
+    Token bucket whose rate adapts to the upstream site.
+
+    Every request takes a token, tokens come back at `rate` per second up to `burst`. The rate is halved whenever the
+    site signals overload (429/503, errors or slow pages) and grows back slowly with every normal response, so the
+    limiter settles just below what the site tolerates.
+
+    Attributes:
+        max_rate    (float):    Highest rate in requests per second
+        min_rate    (float):    Lowest rate in requests per second
+        burst       (int):      Size of the bucket
+        rate        (float):    Current rate in requests per second
+    """
+
+    def __init__(self, rate=UPSTREAM_RATE, burst=UPSTREAM_BURST, min_rate=UPSTREAM_MIN_RATE):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self.rate = rate
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = monotonic()
+        self._blocked_until = 0
+        self._queued = 0
+        self._requests = 0
+        self._throttled = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        with self._lock:
+            self._queued += 1
+        try:
+            while True:
+                with self._lock:
+                    now = monotonic()
+                    self._refill(now)
+                    if now >= self._blocked_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        self._requests += 1
+                        return
+                    wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+                sleep(wait)
+        finally:
+            with self._lock:
+                self._queued -= 1
+
+    def throttled(self, retry_after=None):
+        """
+        Reports that the site pushed back.
+        :param retry_after: Seconds the site asked to wait before the next request, if it said so.
+        """
+        with self._lock:
+            self._refill(monotonic())
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._throttled += 1
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, monotonic() + retry_after)
+
+    def succeeded(self):
+        """Reports a normal response, the rate grows back by a twentieth of max_rate."""
+        with self._lock:
+            self._refill(monotonic())
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def stats(self):
+        """
+        :return: Dict with the current rate, the number of requests waiting for a token and counters of requests sent
+                 and of times the site pushed back.
+        """
+        with self._lock:
+            return {'rate': self.rate, 'max_rate': self.max_rate, 'queued': self._queued,
+                    'requests': self._requests, 'throttled': self._throttled}
+
+
+def backoff(attempt, base=1.0, cap=60.0):
+    """Returns the seconds to wait before retry number attempt (0 based), exponential with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from time import time
+
+import file_converter  # imported first, it sets up fanfiction_net_api
+from fanfiction_net_api import ReviewsGenerator
+
+# SQLite database holding how far the reviews of every synced story and chapter are known
+REVIEW_SYNC_DB = os.environ.get('REVIEW_SYNC_DB', os.path.join('cache', 'reviews.sqlite'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS review_marks (
+    story_id INTEGER NOT NULL,
+    chapter INTEGER NOT NULL,
+    newest INTEGER,
+    known TEXT NOT NULL,
+    review_count INTEGER NOT NULL,
+    synced REAL NOT NULL,
+    PRIMARY KEY (story_id, chapter)
+);
+"""
+
+# Number of newest reviews remembered, a sync stops at the first of them it sees again
+_KNOWN_REVIEWS = 15
+
+
+def review_key(review):
+    """Returns a string identifying a review, fanfiction.net doesn't give reviews an id."""
+    identity = '\x1f'.join(str(value) for value in (review.timestamp, review.user_id, review.user_name,
+                                                     review.chapter, review.text))
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+class ReviewSync(object):
+    """
+    Fetches the reviews posted since the previous sync of a story, or of a chapter.
+
+    Review pages list the newest reviews first. For every story (chapter 0) and chapter a high-water mark is kept: the
+    time of the newest review and the keys of the newest reviews. A sync reads pages one at a time from the first and
+    stops at the first review which is known or older than the mark, so a story with a few new reviews costs a single
+    request. The first sync of a story has nothing to stop at and crawls all pages concurrently.
+
+    >>> sync = ReviewSync()
+    >>> for review in sync.sync(story_id):
+    ...     print(review.user_name, review.text)
+
+    Attributes:
+        db_path (str):  Path of the SQLite database
+        workers (int):  Number of pages fetched at once by a first sync, REVIEW_FETCH_WORKERS by default
+    """
+
+    def __init__(self, db_path=REVIEW_SYNC_DB, workers=None):
+        self.db_path = db_path
+        self.workers = workers
+        self._local = threading.local()
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db().executescript(_SCHEMA)
+
+    def _db(self):
+        """Returns the connection of the current thread, sqlite3 connections can't be shared between threads."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.db = db
+        return db
+
+    def mark(self, story_id, chapter=0):
+        """
+        :return: The high-water mark of a story or chapter as a dict with the columns of the review_marks table, or
+                 None if it was never synced.
+        """
+        row = self._db().execute('SELECT newest, known, review_count, synced FROM review_marks '
+                                 'WHERE story_id = ? AND chapter = ?', (int(story_id), int(chapter))).fetchone()
+        if row is None:
+            return None
+        return {'story_id': int(story_id), 'chapter': int(chapter), 'newest': row[0], 'known': json.loads(row[1]),
+                'review_count': row[2], 'synced': row[3]}
+
+    def sync(self, story_id, chapter=0):
+        """
+        Downloads the reviews posted since the previous sync and moves the mark past them. The mark only moves when
+        the sync completes, reviews of a sync that failed are fetched again by the next one.
+        :param story_id: The story id of the story.
+        :param chapter: The chapter number, 0 for the reviews of all chapters.
+        :return: List of the new reviews, newest first.
+        """
+        mark = self.mark(story_id, chapter)
+        if mark is None:
+            reviews = list(ReviewsGenerator(story_id, chapter, workers=self.workers, cached=False))
+        else:
+            known = set(mark['known'])
+            reviews = []
+            # One page at a time, most syncs end on the first page
+            for review in ReviewsGenerator(story_id, chapter, workers=1, cached=False):
+                if review_key(review) in known or \
+                        (review.timestamp is not None and mark['newest'] is not None and
+                         review.timestamp < mark['newest']):
+                    break
+                reviews.append(review)
+
+        if reviews or mark is None:
+            self._save(story_id, chapter, mark, reviews)
+        return reviews
+
+    def forget(self, story_id, chapter=0):
+        """Removes the mark of a story or chapter, its next sync downloads all reviews again."""
+        self._db().execute('DELETE FROM review_marks WHERE story_id = ? AND chapter = ?', (int(story_id), int(chapter)))
+
+    def _save(self, story_id, chapter, mark, reviews):
+        known = [review_key(review) for review in reviews[:_KNOWN_REVIEWS]]
+        newest = None
+        review_count = len(reviews)
+        if mark is not None:
+            # Keep remembering older reviews when there are only a few new ones
+            known += mark['known'][:_KNOWN_REVIEWS - len(known)]
+            newest = mark['newest']
+            review_count += mark['review_count']
+        timestamps = [review.timestamp for review in reviews if review.timestamp is not None]
+        if timestamps:
+            newest = max([newest or 0] + timestamps)
+
+        self._db().execute('INSERT OR REPLACE INTO review_marks (story_id, chapter, newest, known, review_count, '
+                           'synced) VALUES (?, ?, ?, ?, ?, ?)',
+                           (int(story_id), int(chapter), newest, json.dumps(known), review_count, time()))
@@ -0,0 +1,208 @@
+import struct
+import sys
+from array import array
+
+import file_converter  # imported first, it sets up fanfiction_net_api
+from fanfiction_net_api import Review
+
+# First bytes of a saved table and version of the layout after them
+_MAGIC = b'FFREVTBL'
+_VERSION = 1
+# Stored for missing user ids (anonymous reviews) and timestamps
+_MISSING = -1
+
+
+class _StringPool(object):
+    """Distinct strings of a column, rows store the index of their string."""
+
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self._index = {string: i for i, string in enumerate(self.strings)}
+
+    def index(self, string):
+        i = self._index.get(string)
+        if i is None:
+            i = self._index[string] = len(self.strings)
+            self.strings.append(sys.intern(string))
+        return i
+
+
+class ReviewTable(object):
+    """
+    Reviews stored column by column, for keeping millions of them in memory.
+
+    Ids and timestamps are arrays of machine integers. User names, chapters and times repeat a lot, every distinct
+    value is stored once and rows hold its index. Texts are kept encoded in a single buffer with the offset of the end
+    of each text. Rows are turned back into Review objects when they are read.
+
+    >>> table = ReviewTable(story.get_reviews())
+    >>> table.save('reviews.bin')
+    >>> table = ReviewTable.load('reviews.bin')
+    >>> len(table), table[0].text
+
+    Attributes:
+        COLUMNS List(str):  names of the columns, the attributes of Review
+    """
+    COLUMNS = ('story_id', 'user_id', 'user_name', 'chapter', 'time_ago', 'timestamp', 'text')
+
+    def __init__(self, reviews=()):
+        self._story_ids = array('q')
+        self._user_ids = array('q')
+        self._timestamps = array('q')
+        self._user_names = array('i')
+        self._chapters = array('i')
+        self._times = array('i')
+        self._pools = {'user_name': _StringPool(), 'chapter': _StringPool(), 'time_ago': _StringPool()}
+        self._text = bytearray()
+        self._text_ends = array('Q')
+
+        self.extend(reviews)
+
+    def append(self, review):
+        """Adds a review as the last row."""
+        self._story_ids.append(review.story_id)
+        self._user_ids.append(_MISSING if review.user_id is None else review.user_id)
+        self._timestamps.append(_MISSING if review.timestamp is None else review.timestamp)
+        self._user_names.append(self._pools['user_name'].index(review.user_name))
+        self._chapters.append(self._pools['chapter'].index(review.chapter))
+        self._times.append(self._pools['time_ago'].index(review.time_ago))
+        self._text += review.text.encode('utf-8')
+        self._text_ends.append(len(self._text))
+
+    def extend(self, reviews):
+        """Adds reviews, e.g. from a ReviewsGenerator, as the last rows."""
+        for review in reviews:
+            self.append(review)
+
+    def __len__(self):
+        return len(self._story_ids)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('review index out of range')
+        user_id = self._user_ids[i]
+        timestamp = self._timestamps[i]
+        return Review.from_values(story_id=self._story_ids[i],
+                                  user_id=None if user_id == _MISSING else user_id,
+                                  user_name=self._pools['user_name'].strings[self._user_names[i]],
+                                  chapter=self._pools['chapter'].strings[self._chapters[i]],
+                                  time_ago=self._pools['time_ago'].strings[self._times[i]],
+                                  timestamp=None if timestamp == _MISSING else timestamp,
+                                  text=self.text(i))
+
+    def text(self, i):
+        """Returns the text of the review in row i, without creating the review."""
+        start = self._text_ends[i - 1] if i > 0 else 0
+        return self._text[start:self._text_ends[i]].decode('utf-8')
+
+    def column(self, name):
+        """
+        Returns all values of a column.
+        :param name: One of COLUMNS.
+        :return: List of the values, None for missing user ids and timestamps.
+        """
+        if name == 'story_id':
+            return self._story_ids.tolist()
+        if name in ('user_id', 'timestamp'):
+            values = self._user_ids if name == 'user_id' else self._timestamps
+            return [None if value == _MISSING else value for value in values]
+        if name in self._pools:
+            strings = self._pools[name].strings
+            indexes = {'user_name': self._user_names, 'chapter': self._chapters, 'time_ago': self._times}[name]
+            return [strings[i] for i in indexes]
+        if name == 'text':
+            return [self.text(i) for i in range(len(self))]
+        raise KeyError(name)
+
+    def _arrays(self):
+        return [self._story_ids, self._user_ids, self._timestamps, self._user_names, self._chapters, self._times,
+                self._text_ends]
+
+    def save(self, path):
+        """
+        Writes the table to a packed binary file: a header, then every column array and string pool as
+        little-endian machine integers, and the text buffer.
+        :param path: The path of the file.
+        """
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(struct.pack('<IQ', _VERSION, len(self)))
+            for values in self._arrays():
+                _write_array(f, values)
+            for name in ('user_name', 'chapter', 'time_ago'):
+                encoded = [string.encode('utf-8') for string in self._pools[name].strings]
+                _write_array(f, array('Q', [len(string) for string in encoded]))
+                _write_bytes(f, b''.join(encoded))
+            _write_bytes(f, self._text)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a table written by save.
+        :param path: The path of the file.
+        :return: The table.
+        """
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+        if data[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('%s is not a review table' % path)
+        version, rows = struct.unpack_from('<IQ', data, len(_MAGIC))
+        if version != _VERSION:
+            raise ValueError('Unsupported review table version %d' % version)
+        offset = len(_MAGIC) + struct.calcsize('<IQ')
+
+        table = cls()
+        for values in table._arrays():
+            offset = _read_array(data, offset, values)
+        for name in ('user_name', 'chapter', 'time_ago'):
+            lengths = array('Q')
+            offset = _read_array(data, offset, lengths)
+            blob, offset = _read_bytes(data, offset)
+            strings = []
+            start = 0
+            for length in lengths:
+                strings.append(bytes(blob[start:start + length]).decode('utf-8'))
+                start += length
+            table._pools[name] = _StringPool(strings)
+        text, offset = _read_bytes(data, offset)
+        table._text = bytearray(text)
+
+        if len(table) != rows or any(len(values) != rows for values in table._arrays()):
+            raise ValueError('%s is truncated or damaged' % path)
+        return table
+
+
+def _write_bytes(f, data):
+    f.write(struct.pack('<Q', len(data)))
+    f.write(data)
+
+
+def _read_bytes(data, offset):
+    (length,) = struct.unpack_from('<Q', data, offset)
+    offset += 8
+    return data[offset:offset + length], offset + length
+
+
+def _write_array(f, values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    f.write(values.typecode.encode('ascii'))
+    _write_bytes(f, values.tobytes())
+
+
+def _read_array(data, offset, values):
+    typecode = bytes(data[offset:offset + 1]).decode('ascii')
+    if typecode != values.typecode:
+        raise ValueError('Column of type %s where %s was expected' % (typecode, values.typecode))
+    blob, offset = _read_bytes(data, offset + 1)
+    values.frombytes(blob)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return offset
@@ -0,0 +1,39 @@
+from ebooklib import epub
+
+
+def _book(*file_names):
+    book = epub.EpubBook()
+    items = []
+    for file_name in file_names:
+        item = epub.EpubHtml(title=file_name, file_name=file_name)
+        book.add_item(item)
+        items.append(item)
+    return book, items
+
+
+def test_rename_after_add():
+    book, (item,) = _book('a.xhtml')
+    item.file_name = 'renamed.xhtml'
+    assert book.get_item_with_href('renamed.xhtml') is item
+    assert book.get_item_with_href('a.xhtml') is None
+
+
+def test_rename_after_replace():
+    book, (old, other) = _book('a.xhtml', 'b.xhtml')
+    new = epub.EpubHtml(title='new', file_name='a.xhtml')
+    book.replace_item(old, new)
+    assert book.get_item_with_href('a.xhtml') is new
+
+    new.file_name = 'renamed.xhtml'
+    assert book.get_item_with_href('renamed.xhtml') is new
+    assert book.get_item_with_href('a.xhtml') is None
+    assert book.get_item_with_href('b.xhtml') is other
+
+
+def test_replaced_item_no_longer_indexed():
+    book, (old,) = _book('a.xhtml')
+    book.replace_item(old, epub.EpubHtml(title='new', file_name='a.xhtml'))
+    book._sync_index()
+    old.file_name = 'old.xhtml'
+    assert not book._index_stale
+    assert book.get_item_with_href('old.xhtml') is None
@@ -0,0 +1,38 @@
+import file_converter  # imported first, it sets up fanfiction_net_api
+import bs4
+import fixtures
+from fanfiction_net_api import Story
+
+
+def _upper_case_markup(page):
+    for old, new in (('<select', '<SELECT'), ('</select>', '</SELECT>'), ('<option', '<OPTION'),
+                     ('</option>', '</OPTION>'), ('name=chapter', 'Name=chapter')):
+        page = page.replace(old, new)
+    return page
+
+
+def test_chapter_titles():
+    story = Story(1)
+    story.parse_source(fixtures.story_page(1))
+    assert story.chapter_titles == ['1. Chapter title 1', '2. Chapter title 2', '3. Chapter title 3']
+
+
+def test_chapter_titles_upper_case_markup():
+    story = Story(1)
+    story.parse_source(_upper_case_markup(fixtures.story_page(1)))
+    assert story.chapter_titles == ['1. Chapter title 1', '2. Chapter title 2', '3. Chapter title 3']
+
+
+def test_storylist_entities():
+    entry = fixtures._storylist_entry(1)
+    entry = entry.replace("data-category='Naruto'", "data-category='Tom &amp; Jerry &amp; Naruto'")
+    entry = entry.replace("data-title='Story 1'", "data-title='Tom &amp; Jerry&#39;s Story'")
+    entry = entry.replace('Naruto U., Hinata H.', 'Naruto U., O&#39;Malley &amp; Co')
+    chunk = bs4.BeautifulSoup(entry, 'html.parser').find('div')
+
+    story = Story(1)
+    story._parse_from_storylist_format(chunk)
+    assert story.title == "Tom & Jerry's Story"
+    assert story.fandoms == ['Tom', 'Jerry', 'Naruto']
+    assert story.characters == ['Naruto U.', "O'Malley & Co"]
+    assert story.genre == ['Romance', 'Drama']